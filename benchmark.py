@@ -0,0 +1,241 @@
+"""
+Rough timings for RedShell internals. Each benchmark runs against a throwaway engagement
+directory, so it never touches the real database.
+
+    python benchmark.py startup --targets 200 --methods 5
+    python benchmark.py completion --paths 1000000
+    python benchmark.py database --commands 1000000
+    python benchmark.py search --outputs 20000 --lines 100
+"""
+import os
+import time
+import argparse
+import tempfile
+
+def startup_benchmark(target_count: int, method_count: int) -> None:
+    """
+    Times RSH startup and loading every target's methods with a seeded database.
+    """
+    from redshell import RSH
+    from redshell.database import db_session
+    from redshell.models import Target, Credential, Method
+
+    # First instance creates the database
+    RSH()
+
+    # Credentials are unique, every target shares the same ones
+    credentials = [
+        Credential(username=f"user{j}", ctype="password", cred=f"password{j}", origin="Benchmark")
+        for j in range(method_count)
+    ]
+    for i in range(target_count):
+        target = Target(ip_addr=f"10.{i // 65536}.{i // 256 % 256}.{i % 256}", hostname=f"host{i}")
+        for credential in credentials:
+            target.credentials.append(credential)
+            target.methods.append(Method(method_type="wmi", status="Unused", credential=credential))
+        db_session.add(target)
+    db_session.commit()
+    db_session.remove()
+
+    start = time.perf_counter()
+    rsh = RSH()
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(target_count):
+        len(rsh.targets[f"host{i}"].methods)
+    load = time.perf_counter() - start
+
+    print(f"{target_count} targets, {target_count * method_count} methods")
+    print(f"RSH() startup:        {startup:.3f}s")
+    print(f"Load every method:    {load:.3f}s")
+    print(f"Per method:           {(startup + load) / (target_count * method_count) * 1000:.3f}ms")
+
+def completion_benchmark(path_count: int) -> None:
+    """
+    Times filesystem tracking and path completion for a single target.
+    """
+    from prompt_toolkit.document import Document
+    from redshell import RSH
+    from redshell.rshcompleters import FilesystemCompleter
+
+    rsh = RSH()
+    rsh.targets.append(ip_addr="10.0.0.1", hostname="host0")
+    target = rsh.targets["host0"]
+
+    # 100 top level dirs of 100 subdirs, files spread evenly under them
+    paths = []
+    for i in range(path_count):
+        paths.append(f"/dir{i % 100}/sub{i // 100 % 100}/file{i}")
+    start = time.perf_counter()
+    for i in range(0, path_count, 50000):
+        target.filesystem.add(paths[i:i + 50000])
+    insert = time.perf_counter() - start
+
+    class Method:
+        pass
+    method = Method()
+    method.target = target
+    completer = FilesystemCompleter(method)
+
+    # First completion builds the directory tree
+    start = time.perf_counter()
+    list(completer.get_completions(Document("/"), None))
+    build = time.perf_counter() - start
+
+    typed = ["/", "/dir1", "/dir42/", "/dir42/sub7", "/dir42/sub7/", "/dir42/sub7/file1"]
+    rounds = 200
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in typed:
+            list(completer.get_completions(Document(text), None))
+    keystroke = (time.perf_counter() - start) / (rounds * len(typed))
+
+    print(f"{path_count} paths")
+    print(f"Track every path:      {insert:.3f}s")
+    print(f"Build completion tree: {build:.3f}s")
+    print(f"Per keystroke:         {keystroke * 1000:.3f}ms")
+
+def database_benchmark(command_count: int, target_count: int) -> None:
+    """
+    Times Command inserts and the lookups run against the command and credential tables.
+    """
+    from sqlalchemy import select, func
+    from redshell import RSH
+    from redshell.journal import journal
+    from redshell.blobs import blob_store
+    from redshell.database import db_session
+    from redshell.models import Target, Credential, Command
+
+    RSH()
+    targets = [Target(ip_addr=f"10.0.{i // 256}.{i % 256}") for i in range(target_count)]
+    db_session.add_all(targets)
+    db_session.commit()
+    target_ids = [target.id for target in targets]
+
+    # One commit per command, the way methods used to write them
+    single_count = min(2000, command_count)
+    start = time.perf_counter()
+    for i in range(single_count):
+        db_session.add(Command(target_id=target_ids[i % target_count], command_line=f"whoami {i}", result="nt authority\\system"))
+        db_session.commit()
+    single = time.perf_counter() - start
+
+    # Through the journal, the way methods write them now
+    result_hash = blob_store.put("nt authority\\system")
+    start = time.perf_counter()
+    for i in range(single_count, command_count):
+        journal.write(target_ids[i % target_count], f"whoami {i}", result_hash)
+    queued = time.perf_counter() - start
+    journal.flush()
+    batched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for target_id in target_ids:
+        list(db_session.scalars(
+            select(Command).where(Command.target_id == target_id).order_by(Command.time_run.desc()).limit(50)
+        ))
+    latest = (time.perf_counter() - start) / target_count
+
+    start = time.perf_counter()
+    for target_id in target_ids:
+        db_session.scalar(select(func.count()).select_from(Command).where(Command.target_id == target_id))
+    count = (time.perf_counter() - start) / target_count
+
+    db_session.add_all([
+        Credential(username=f"user{i}", ctype="nthash", cred=f"{i:032x}", origin="Benchmark")
+        for i in range(10000)
+    ])
+    db_session.commit()
+    start = time.perf_counter()
+    for i in range(1000):
+        db_session.query(Credential).filter(
+            Credential.username==f"user{i}", Credential.ctype=="nthash", Credential.cred==f"{i:032x}",
+            Credential.domain==None, Credential.origin=="Benchmark",
+        ).count()
+    dedupe = (time.perf_counter() - start) / 1000
+
+    print(f"{command_count} commands over {target_count} targets")
+    print(f"Single commit insert:  {single_count / single:.0f} commands/s")
+    print(f"Journal insert:        {(command_count - single_count) / batched:.0f} commands/s")
+    print(f"Journal write call:    {queued / (command_count - single_count) * 1000000:.1f}us")
+    print(f"Latest 50 for target:  {latest * 1000:.3f}ms")
+    print(f"Count for target:      {count * 1000:.3f}ms")
+    print(f"Credential dedupe:     {dedupe * 1000:.3f}ms")
+
+def search_benchmark(output_count: int, line_count: int) -> None:
+    """
+    Times indexing command output for search and querying it.
+    """
+    from redshell import RSH
+    from redshell.journal import journal
+    from redshell.blobs import blob_store
+    from redshell.database import engine, database_path
+
+    rsh = RSH()
+    rsh.targets.append(ip_addr="10.0.0.1", hostname="host0")
+    target_id = rsh.targets["host0"].id
+
+    start = time.perf_counter()
+    for i in range(output_count):
+        output = "\n".join(f"proc{i}_{j}.exe {j} Console {i * j % 65536} K" for j in range(line_count))
+        journal.write(target_id, f"tasklist {i}", blob_store.put(output), output)
+    journal.flush()
+    indexed = time.perf_counter() - start
+
+    queries = [f"proc{output_count // 2}_7.exe", "Console", f"proc{output_count - 1}_{line_count - 1}.exe"]
+    rounds = 20
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query in queries:
+            rsh.search(query)
+    per_query = (time.perf_counter() - start) / (rounds * len(queries))
+
+    journal.flush()
+    # Checkpoint so the WAL is counted in the database file
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    database_size = os.path.getsize(database_path)
+    blob_size = sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(blob_store.path) for name in names
+    )
+
+    print(f"{output_count} outputs, {output_count * line_count} lines")
+    print(f"Store and index:       {output_count / indexed:.0f} outputs/s")
+    print(f"Per search:            {per_query * 1000:.3f}ms")
+    print(f"Database size:         {database_size / 2**20:.1f}MB")
+    print(f"Blob store size:       {blob_size / 2**20:.1f}MB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    startup_parser = subparsers.add_parser("startup")
+    startup_parser.add_argument("--targets", type=int, default=200)
+    startup_parser.add_argument("--methods", type=int, default=5)
+
+    completion_parser = subparsers.add_parser("completion")
+    completion_parser.add_argument("--paths", type=int, default=1000000)
+
+    database_parser = subparsers.add_parser("database")
+    database_parser.add_argument("--commands", type=int, default=1000000)
+    database_parser.add_argument("--targets", type=int, default=100)
+
+    search_parser = subparsers.add_parser("search")
+    search_parser.add_argument("--outputs", type=int, default=20000)
+    search_parser.add_argument("--lines", type=int, default=100)
+
+    args = parser.parse_args()
+
+    # redshell reads config.json and the database from the working directory on import
+    os.chdir(tempfile.mkdtemp(prefix="rsh_benchmark_"))
+
+    if args.benchmark == "startup":
+        startup_benchmark(args.targets, args.methods)
+    elif args.benchmark == "completion":
+        completion_benchmark(args.paths)
+    elif args.benchmark == "database":
+        database_benchmark(args.commands, args.targets)
+    elif args.benchmark == "search":
+        search_benchmark(args.outputs, args.lines)
@@ -0,0 +1,9 @@
+#!/bin/sh
+# Per-method configs are mounted at /rsh, so one image can serve every method and credential
+if [ -f /rsh/config ]; then
+    install -m 600 /rsh/config /root/.ssh/config
+fi
+if [ -f /rsh/proxychains.conf ]; then
+    cp /rsh/proxychains.conf /etc/proxychains/proxychains.conf
+fi
+exec "$@"
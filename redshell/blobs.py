@@ -0,0 +1,54 @@
+import os
+import gzip
+import uuid
+import hashlib
+from redshell import config
+
+class BlobStore:
+    """
+    Command output stored once per distinct content, gzip compressed, under
+    <path>/<first two hash chars>/<sha256>.gz.
+
+    Identical output from different commands or hosts (tasklist, systeminfo, ...) takes up space
+    once, rows and cmd/ logs only hold its hash.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], f"{digest}.gz")
+
+    def put(self, data) -> str:
+        """
+        Stores data if it isn't stored already and returns its hash.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under a temporary name so nothing ever reads half a blob
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with gzip.open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        return digest
+
+    def get(self, digest: str) -> str:
+        with gzip.open(self.blob_path(digest), "rb") as f:
+            return f.read().decode(errors="replace")
+
+    def link(self, digest: str, link_path: str) -> None:
+        """
+        Points link_path at a stored blob, replacing whatever was there.
+        """
+        target = os.path.relpath(self.blob_path(digest), os.path.dirname(link_path))
+        try:
+            os.symlink(target, link_path)
+        except FileExistsError:
+            os.remove(link_path)
+            os.symlink(target, link_path)
+
+blob_store = BlobStore(os.path.join(config.read_config()["op_path"], "blobs"))
@@ -6,7 +6,7 @@ from prettytable import PrettyTable
 from prompt_toolkit.styles import Style
 from prompt_toolkit.completion import FuzzyCompleter
 from redshell.output_formatter import print_success, print_running, print_fail
-from redshell.models import Target, Credential, Method, Tunnel
+from redshell.models import Target, Credential, Method, Tunnel, OpenPort
 from redshell.database import db_session
 
 class ExitPrompt(Exception):
@@ -127,6 +127,17 @@ class CLI:
             tab.add_row(row)
         print(tab)
 
+    def show_ports(self, **_) -> None:
+        """
+        Shows open ports found by portscan runs from the current target.
+        """
+        columns = ["ID", "Host", "Port", "Last Seen"]
+        tab = PrettyTable(columns)
+        ports = db_session.query(OpenPort).filter(OpenPort.target_id==self.target.id).order_by(OpenPort.host, OpenPort.port).all()
+        for i, open_port in enumerate(ports):
+            tab.add_row([i, open_port.host, open_port.port, open_port.time_seen])
+        print(tab)
+
     def show_containers(self, **_) -> None:
         """
         Shows table of existing containers running on the system spawned by RedShell.
@@ -141,6 +152,68 @@ class CLI:
             tab.add_row(row)
         print(tab)
 
+    def show_latency(self, **_) -> None:
+        """
+        Shows how long each command run by the current method took, per execution mode.
+        """
+
+        if not getattr(self.method, "latencies", None):
+            print_fail("No command timings recorded for this method")
+            return
+
+        columns = ["ID", "Command", "Mode", "Seconds"]
+        tab = PrettyTable(columns)
+        for i, (command, mode, latency) in enumerate(self.method.latencies):
+            tab.add_row([i, command, mode, f"{latency:.3f}"])
+        print(tab)
+
+        # Averages make the difference between modes easy to see
+        modes = {}
+        for _, mode, latency in self.method.latencies:
+            modes.setdefault(mode, []).append(latency)
+        for mode, mode_latencies in modes.items():
+            print_running(f"{mode}: {len(mode_latencies)} commands, {sum(mode_latencies) / len(mode_latencies):.3f}s average")
+
+    def show_compression(self, **_) -> None:
+        """
+        Shows how many bytes compression saved on each command and payload of the current method.
+        """
+        if not getattr(self.method, "compression_stats", None):
+            print_fail("No compressed commands recorded for this method")
+            return
+
+        columns = ["ID", "Command", "Plain bytes", "Sent bytes", "Saved"]
+        tab = PrettyTable(columns)
+        for i, (command, plain_bytes, wire_bytes) in enumerate(self.method.compression_stats):
+            # Wrapped and raw docker commands get long, the start is enough to recognise them
+            if len(command) > 60:
+                command = command[:57] + "..."
+            tab.add_row([i, command, plain_bytes, wire_bytes, plain_bytes - wire_bytes])
+        print(tab)
+
+        plain_total = sum(plain_bytes for _, plain_bytes, _ in self.method.compression_stats)
+        wire_total = sum(wire_bytes for _, _, wire_bytes in self.method.compression_stats)
+        print_running(f"{plain_total - wire_total} of {plain_total} bytes saved ({100 * (plain_total - wire_total) / max(plain_total, 1):.1f}%)")
+
+    def show_search(self, query: list, target: str=None, limit: int=20, raw: bool=False, **_) -> None:
+        """
+        Shows commands whose output matches the query, best matches first.
+        """
+        if not query:
+            print_fail("Give something to search for")
+            return
+        results = self.rsh.search(' '.join(query), target=target, limit=limit, raw=raw)
+        if not results:
+            print_fail("No matches")
+            return
+
+        columns = ["Target", "Command", "Time", "Match"]
+        tab = PrettyTable(columns)
+        tab.align["Match"] = "l"
+        for target_name, command_line, time_run, snippet in results:
+            tab.add_row([target_name, command_line, str(time_run)[:19], snippet.replace("\r", "").replace("\n", " ")])
+        print(tab)
+
     def show_settings(self, **kwargs) -> None:
         settings = {
             "Target": self.target.ip_addr,
@@ -159,6 +232,7 @@ class CLI:
             settings["Tunnel"] = "None"
         if self.method:
             settings["Method"] = self.method.NAME
+            settings["Compression"] = str(self.method.compression or "Off")
         else:
             settings["Method"] = "None"
 
@@ -194,6 +268,9 @@ class CLI:
         show_action_parser = action_subparser.add_parser('show')
         add_action_parser = action_subparser.add_parser('add')
         set_action_parser = action_subparser.add_parser('set')
+        connect_action_parser = action_subparser.add_parser('connect')
+        run_all_action_parser = action_subparser.add_parser('run-all')
+        search_action_parser = action_subparser.add_parser('search')
 
         # 'show' parsers
         show_action_subparser = show_action_parser.add_subparsers(dest="noun")
@@ -202,6 +279,25 @@ class CLI:
         show_action_targets_parser.set_defaults(func=self.show_targets)
         #show_action_settings_parser = show_action_subparser.add_parser('settings')
 
+        # 'connect' parser
+        connect_action_parser.add_argument('targets', nargs='*')
+        connect_action_parser.add_argument('--all', dest='all', action="store_true")
+        connect_action_parser.add_argument('--workers', dest='workers', type=int, default=8)
+        connect_action_parser.set_defaults(func=self.rsh.connect_all)
+
+        # 'run-all' parser, options have to come before the command
+        run_all_action_parser.add_argument('--targets', dest='targets', type=lambda value: value.split(','))
+        run_all_action_parser.add_argument('--builtin', dest='builtin', type=str)
+        run_all_action_parser.add_argument('--workers', dest='workers', type=int, default=8)
+        run_all_action_parser.add_argument('command', nargs=argparse.REMAINDER)
+
+        # 'search' parser
+        search_action_parser.add_argument('--target', dest='target', type=str)
+        search_action_parser.add_argument('--limit', dest='limit', type=int, default=20)
+        search_action_parser.add_argument('--raw', dest='raw', action="store_true")
+        search_action_parser.add_argument('query', nargs=argparse.REMAINDER)
+        search_action_parser.set_defaults(func=self.show_search)
+
         # 'add' parsers
         add_action_subparser = add_action_parser.add_subparsers(dest='noun')
         add_action_target_parser = add_action_subparser.add_parser('target')
@@ -221,6 +317,13 @@ class CLI:
                 #self.target = self.rsh.targets[args.ip]
                 self.target = self.rsh.targets[args.value]
                 self.next_parser = 'target'
+            elif args.action == 'connect' and not args.targets and not args.all:
+                print_fail("Give target names to connect, or --all for every target")
+            elif args.action == 'run-all':
+                if not args.command and args.builtin is None:
+                    print_fail("Give a command or --builtin to run")
+                else:
+                    self.rsh.run_all(' '.join(args.command), targets=args.targets, builtin=args.builtin, workers=args.workers)
             # All other functions will take only correct args
             else:
                 args.func(**vars(args))
@@ -241,6 +344,7 @@ class CLI:
         add_action_parser = action_subparser.add_parser('add')
         set_action_parser = action_subparser.add_parser('set')
         unset_action_parser = action_subparser.add_parser('unset')
+        connect_action_parser = action_subparser.add_parser('connect')
 
         # 'show' parsers
         show_action_subparser = show_action_parser.add_subparsers(dest="noun")
@@ -264,6 +368,9 @@ class CLI:
         show_action_containers_parser = show_action_subparser.add_parser("containers")
         show_action_containers_parser.set_defaults(func=self.show_containers)
 
+        show_action_ports_parser = show_action_subparser.add_parser("ports")
+        show_action_ports_parser.set_defaults(func=self.show_ports)
+
         # 'add' parsers
         add_action_subparser = add_action_parser.add_subparsers(dest='noun')
 
@@ -301,6 +408,10 @@ class CLI:
         # 'unset' parsers
         unset_action_parser.add_argument("setting")
 
+        # 'connect' parser, connects every method of the current target
+        connect_action_parser.add_argument('--workers', dest='workers', type=int, default=8)
+        connect_action_parser.set_defaults(func=self.rsh.connect_all, targets=[self.target.hostname or self.target.ip_addr])
+
         # Parse options
         try:
             args = parser.parse_args(command)
@@ -406,7 +517,20 @@ class CLI:
         show_action_settings_parser = show_action_subparser.add_parser('settings')
         show_action_settings_parser.set_defaults(func=self.show_settings)
 
-        # Single word actions
+        show_action_latency_parser = show_action_subparser.add_parser('latency')
+        show_action_latency_parser.set_defaults(func=self.show_latency)
+
+        show_action_compression_parser = show_action_subparser.add_parser('compression')
+        show_action_compression_parser.set_defaults(func=self.show_compression)
+
+        # 'set' parser
+        set_action_subparser = set_action_parser.add_subparsers(dest="noun")
+        set_action_compression_parser = set_action_subparser.add_parser('compression')
+        set_action_compression_parser.add_argument('state', choices=["on", "off"])
+        set_action_compression_parser.set_defaults(func=self.method.set_compression)
+
+        # 'connect' parser
+        connect_action_parser.add_argument('--timeout', dest='timeout', type=int)
         connect_action_parser.set_defaults(func=self.method.connect)
 
         # 'shell' parser
@@ -469,8 +593,7 @@ class CLI:
 
             args = parser.parse_args(formatted_command)
             if args.action == "get":
-                for file in args.file_path:
-                    self.method.get_file(file)
+                self.method.get_files(args.file_path)
             else:
                 args.func(**vars(args))
         except SystemExit:
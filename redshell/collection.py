@@ -0,0 +1,141 @@
+import os
+import ntpath
+import base64
+import pathlib
+import hashlib
+import threading
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from .database import db_session
+from .models import CollectedFile
+
+# Tab separated size, SHA256 and full path of every file, hashed without locking out writers
+WINDOWS_LIST_SCRIPT = """
+Get-ChildItem -Path {paths} -Recurse -File -Force -ErrorAction SilentlyContinue | ForEach-Object {{
+    try {{
+        $stream = [IO.File]::Open($_.FullName, 'Open', 'Read', 'ReadWrite')
+        $hash = [BitConverter]::ToString([Security.Cryptography.SHA256]::Create().ComputeHash($stream)).Replace('-', '')
+        $stream.Close()
+    }} catch {{ $hash = '' }}
+    $_.Length.ToString() + [char]9 + $hash + [char]9 + $_.FullName
+}}
+"""
+
+class HashIndex:
+    """
+    SHA256 of the files in a target's collection dir, kept in the collected_t table.
+
+    A file is only hashed again once its size or mtime changed, so checking a collection
+    that is already up to date against the target costs a stat per file.
+    """
+
+    def __init__(self, target) -> None:
+        self.target = target
+        self.collect_path = os.path.join(target.op_path, "files")
+        # Relative path -> (size, mtime_ns, sha256), loaded on first use
+        self.entries = None
+        self.pending = {}
+        # Downloads hash their files from worker threads
+        self.lock = threading.Lock()
+
+    def _load(self) -> None:
+        query = select(CollectedFile.path, CollectedFile.size, CollectedFile.mtime_ns, CollectedFile.sha256).where(
+            CollectedFile.target_id == self.target.id
+        )
+        self.entries = {path: (size, mtime_ns, sha256) for path, size, mtime_ns, sha256 in db_session.execute(query)}
+
+    def sha256(self, local_path: str) -> str:
+        """
+        Returns the SHA256 of a collected file, or None if it doesn't exist.
+        """
+        try:
+            stat = os.stat(local_path)
+        except FileNotFoundError:
+            return None
+        path = os.path.relpath(local_path, self.collect_path)
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            entry = self.entries.get(path)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+        digest = sha256_file(local_path)
+        self._set(path, stat, digest)
+        return digest
+
+    def record(self, local_path: str, digest: str) -> None:
+        """
+        Stores the hash of a file that was just downloaded and verified, saving a rehash later.
+        """
+        self._set(os.path.relpath(local_path, self.collect_path), os.stat(local_path), digest)
+
+    def _set(self, path: str, stat, digest: str) -> None:
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            self.entries[path] = (stat.st_size, stat.st_mtime_ns, digest)
+            self.pending[path] = self.entries[path]
+
+    def save(self) -> None:
+        """
+        Writes hashes computed since the last save in one transaction.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        statement = insert(CollectedFile).values([
+            {"target_id": self.target.id, "path": path, "size": size, "mtime_ns": mtime_ns, "sha256": sha256}
+            for path, (size, mtime_ns, sha256) in pending.items()
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=["target_id", "path"],
+            set_={"size": statement.excluded.size, "mtime_ns": statement.excluded.mtime_ns, "sha256": statement.excluded.sha256},
+        )
+        db_session.execute(statement)
+        db_session.commit()
+
+def local_path(collect_path: str, remote_path: str) -> str:
+    """
+    Where a remote file goes in the collection dir. Windows paths lose the colon and are lower
+    cased (C:\\Users\\bob\\a.txt -> c/users/bob/a.txt), Linux paths are kept as they are.
+    """
+    if "\\" in remote_path or ntpath.splitdrive(remote_path)[0]:
+        remote_dir, filename = ntpath.split(remote_path)
+        local_dir = pathlib.PureWindowsPath(remote_dir).as_posix().replace(":", "").lower().lstrip("/")
+        return os.path.join(collect_path, local_dir, filename)
+    return os.path.join(collect_path, remote_path.lstrip("/"))
+
+def sha256_file(path: str, block_size: int=1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def windows_listing(paths: list) -> str:
+    """
+    Command line listing and hashing everything under the given Windows paths, wildcards
+    and directories included, in one go.
+    """
+    return powershell_command(WINDOWS_LIST_SCRIPT.format(paths=", ".join(ps_quote(path) for path in paths)))
+
+def parse_listing(output: str) -> list:
+    """
+    Turns size<TAB>sha256<TAB>path lines into sorted (path, size, sha256) tuples. The hash is
+    empty for files that couldn't be read.
+    """
+    listing = {}
+    for line in output.split("\n"):
+        fields = line.strip().split("\t")
+        if len(fields) == 3 and fields[0].isdigit():
+            listing[fields[2]] = (int(fields[0]), fields[1].lower())
+    return [(remote_path, size, digest) for remote_path, (size, digest) in sorted(listing.items())]
+
+def powershell_command(script: str) -> str:
+    # Encoded so the script survives cmd.exe and wmiexec quoting untouched
+    encoded = base64.b64encode(script.encode("utf-16-le")).decode()
+    return f"powershell -NoProfile -EncodedCommand {encoded}"
+
+def ps_quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
@@ -1,6 +1,8 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session
 from redshell import config
+from redshell.output_formatter import print_fail
 
 Base = declarative_base()
 
@@ -8,10 +10,68 @@ database_path = config.read_config()['database_path']
 
 engine = create_engine(f"sqlite:///{database_path}")
 
+# Connection settings applied to every new SQLite connection
+PRAGMAS = {
+    # Readers don't block the writer and commits only append to the log
+    "journal_mode": "WAL",
+    # With WAL this only risks the last commits on power loss, never corruption
+    "synchronous": "NORMAL",
+    # Negative means KiB, so 64MB of page cache
+    "cache_size": -64000,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+@event.listens_for(engine, "connect")
+def _set_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for pragma, value in PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
 db_session = scoped_session(
     sessionmaker(
         bind=engine,
         autocommit=False,
         autoflush=False
     )
-)
\ No newline at end of file
+)
+
+# Indexes replaced by differently named ones, dropped from databases that still have them
+DROPPED_INDEXES = [
+    # Left tunnel_id NULL for methods without a tunnel, so it never caught duplicates
+    "ix_method_unique",
+    # Superseded by ix_credential_key, which also compares a missing domain as ''
+    "ix_credential_unique",
+]
+
+def migrate() -> None:
+    """
+    Brings a database created by an older version up to the current schema.
+
+    create_all() only creates missing tables, so columns and indexes added to existing tables
+    since then are created here. Unique indexes that existing duplicate rows would break are
+    skipped.
+    """
+    with engine.begin() as connection:
+        for index in DROPPED_INDEXES:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index}")
+    inspector = inspect(engine)
+    # Reflection leaves out indexes on expressions, so go by name
+    with engine.connect() as connection:
+        indexes = set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type='index'").scalars())
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                # Rows that already exist get NULL, new columns have to allow it
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as connection:
+                    connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+        for index in table.indexes:
+            if index.name in indexes:
+                continue
+            try:
+                index.create(bind=engine)
+            except IntegrityError:
+                print_fail(f"Duplicate rows in {table.name}, skipping unique index {index.name}")
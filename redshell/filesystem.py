@@ -0,0 +1,101 @@
+import os
+from bisect import bisect_left
+from itertools import islice
+from sqlalchemy import insert, select
+from .database import db_session
+from .models import FilesystemPath
+
+class FilesystemTracker:
+    """
+    Index of remote paths collected from a target, kept in the filesystem_t table.
+
+    Directories end with their separator ('/' or '\\'), the same format the old filesystem.txt
+    used. Paths are unique per target, so adding a path that is already known is a no-op.
+    """
+
+    # Bumped on every write, so caches built from a tracker know when to reload
+    versions = {}
+
+    def __init__(self, target) -> None:
+        self.target = target
+        self.legacy_file = os.path.join(target.op_path, "filesystem.txt")
+        self.imported = False
+        # Directory -> sorted child paths, rebuilt when the version moves past tree_version
+        self.tree = None
+        self.tree_version = None
+
+    @property
+    def version(self) -> int:
+        return self.versions.get(self.target.id, 0)
+
+    def add(self, paths) -> int:
+        """
+        Adds paths in one transaction, skipping ones already tracked. Returns how many were new.
+        """
+        self.import_legacy()
+        rows = [{"target_id": self.target.id, "path": path} for path in set(paths) if path]
+        if not rows:
+            return 0
+        result = db_session.execute(insert(FilesystemPath.__table__).prefix_with("OR IGNORE"), rows)
+        db_session.commit()
+        self.versions[self.target.id] = self.version + 1
+        return result.rowcount
+
+    def startswith(self, prefix: str) -> list:
+        """
+        Returns tracked paths starting with prefix, in sorted order.
+        """
+        self.import_legacy()
+        query = select(FilesystemPath.path).where(FilesystemPath.target_id == self.target.id)
+        # Range instead of LIKE so the (target_id, path) index does the work
+        if prefix:
+            query = query.where(FilesystemPath.path >= prefix, FilesystemPath.path < prefix + "\U0010ffff")
+        return list(db_session.scalars(query.order_by(FilesystemPath.path)))
+
+    def children(self, directory: str, prefix: str="") -> list:
+        """
+        Returns tracked paths directly under directory whose name starts with prefix.
+        """
+        if self.tree is None or self.tree_version != self.version:
+            self._build_tree()
+        entries = self.tree.get(directory)
+        if not entries:
+            return []
+        start = bisect_left(entries, directory + prefix)
+        matches = []
+        for entry in islice(entries, start, None):
+            if not entry.startswith(directory + prefix):
+                break
+            matches.append(entry)
+        return matches
+
+    def _build_tree(self) -> None:
+        self.import_legacy()
+        self.tree_version = self.version
+        tree = {}
+        for path in self.startswith(""):
+            tree.setdefault(parent_dir(path), []).append(path)
+        # Paths come out of the index sorted, so every child list already is
+        self.tree = tree
+
+    def import_legacy(self) -> None:
+        """
+        Moves paths from a filesystem.txt written by older versions into the index.
+        """
+        if self.imported:
+            return
+        self.imported = True
+        if not os.path.exists(self.legacy_file):
+            return
+        with open(self.legacy_file, "r", encoding="utf-8") as file:
+            paths = [line.rstrip("\n") for line in file]
+        self.add(paths)
+        os.rename(self.legacy_file, f"{self.legacy_file}.imported")
+
+def parent_dir(path: str) -> str:
+    """
+    Returns the directory a path sits in, with its trailing separator. Works for both Linux and
+    Windows paths, a directory's own trailing separator is ignored.
+    """
+    name = path[:-1] if path.endswith(("/", "\\")) else path
+    return name[:max(name.rfind("/"), name.rfind("\\")) + 1]
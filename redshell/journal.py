@@ -0,0 +1,97 @@
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime, timezone
+from sqlalchemy import insert
+from .database import engine
+from .models import Command
+from .output_formatter import print_fail
+from . import search
+
+class CommandJournal:
+    """
+    Writes Command rows from a background thread, so running a command never waits on a commit.
+
+    Queued commands are written in one transaction once 'batch_size' of them are waiting, or
+    'interval' seconds after the oldest one was queued, whichever comes first. flush() blocks
+    until everything queued before it is in the database.
+    """
+
+    def __init__(self, batch_size: int=100, interval: float=0.5) -> None:
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def write(self, target_id, command_line: str, result_hash: str, output: str=None) -> None:
+        """
+        Queues a Command row. Output passed along is added to the search index.
+        """
+        # Time of the command, not of the commit, in the same UTC format as the column default
+        time_run = datetime.now(timezone.utc).replace(tzinfo=None)
+        row = {"target_id": target_id, "command_line": command_line, "result_hash": result_hash, "time_run": time_run}
+        self.queue.put((row, output))
+        self._start()
+
+    def flush(self, timeout: float=None) -> bool:
+        """
+        Waits for every command queued so far to be written. Returns False on timeout.
+        """
+        if self.worker is None:
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _start(self) -> None:
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+
+    def _run(self) -> None:
+        pending = []
+        waiting = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            # Flush requests are queued behind the commands they have to wait for
+            if isinstance(item, threading.Event):
+                waiting.append(item)
+            elif item is not None:
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.interval
+
+            if waiting or len(pending) >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._write(pending)
+                pending = []
+                deadline = None
+                for done in waiting:
+                    done.set()
+                waiting = []
+
+    def _write(self, pending: list) -> None:
+        if not pending:
+            return
+        try:
+            rows = [row for row, _ in pending]
+            outputs = {row["result_hash"]: output for row, output in pending if output is not None}
+            # Commands and their search index entries land in the same transaction
+            with engine.begin() as connection:
+                connection.execute(insert(Command.__table__), rows)
+                search.index_outputs(connection, outputs)
+        # Anything raised here would kill the worker and leave flush() waiting forever
+        except Exception as err:
+            print_fail(f"Failed to record {len(pending)} commands: {err}")
+
+journal = CommandJournal()
+# Daemon threads are still running when atexit handlers are called
+atexit.register(journal.flush)
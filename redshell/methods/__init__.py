@@ -1,17 +1,39 @@
 import os
+import time
+import uuid
 import random
 import string
+import hashlib
+import threading
 import traceback
 import shutil
+from datetime import datetime
 from importlib import util
 from collections import UserList
+from sqlalchemy.orm import joinedload
+from prettytable import PrettyTable
 import docker
 from docker import errors
 from redshell import config
 from redshell.output_formatter import print_success, print_running, print_fail
 from redshell.database import db_session
 from redshell.methods.builtins import BuiltinBase
-from redshell.models import Method, Target, Command
+from redshell.models import Method, Target
+from redshell.watchers import ConnectWatcher
+from redshell.journal import journal
+from redshell.blobs import blob_store
+from redshell import transport
+from redshell.session import cmd_script, script_chunks, split_script_output
+
+# Every method runs from one image built from ./images, per-method configs get mounted at /rsh
+IMAGE_PATH = "./images"
+IMAGE_NAME = "rsh_base"
+# Tags already confirmed to exist during this session
+built_tags = set()
+# Parallel connects must not build the same image at once
+build_lock = threading.Lock()
+# Seconds to wait for a connect to succeed or fail
+CONNECT_TIMEOUT = 30
 
 
 class MethodsController(UserList):
@@ -20,8 +42,15 @@ class MethodsController(UserList):
         self.target = target
         self.data = []
         self.method_list = { method.NAME: method for method in MethodBase.methods }
-        old_db = db_session.query(Method).filter(Method.target_id==self.target.id).all()
+        # Load credentials and tunnels in the same query instead of one query per method
+        old_db = (
+            db_session.query(Method)
+            .options(joinedload(Method.credential), joinedload(Method.tunnel))
+            .filter(Method.target_id==self.target.id)
+            .all()
+        )
         # For each database entry, create method instance with its attributes
+        # Instances are cheap, Docker and directories are only set up on first use
         for row in old_db:
             self.data.append(self.method_list[row.method_type](self.target, row.credential, row.tunnel, row))
 
@@ -73,6 +102,10 @@ class MethodsController(UserList):
 
 class MethodBase:
     methods = []
+    # transport.Compression in use, set with set_compression()
+    compression = None
+    # False for methods that only give an interactive session, e.g. RDP
+    RUNS_COMMANDS = True
 
     # For every class that inherits from the current,
     # the class name will be added to plugins
@@ -85,27 +118,96 @@ class MethodBase:
             if getattr(cls, f) is getattr(__class__, f):
                 raise NotImplementedError("Methods must implement")
 
+    def setup(self):
+        """
+        Creates the method's directories and gets its Docker image ready. Called on first use,
+        so loading stored methods doesn't touch the disk or Docker.
+        """
+        if self.ready:
+            return
+        for path in self.paths:
+            os.makedirs(path, exist_ok=True)
+        self.docker_build()
+        self.ready = True
+
     def docker_build(self):
-        for file in os.listdir("./images"):
-            full_path = os.path.abspath(f"./images/{file}")
-            shutil.copy(full_path, self.docker_path)
-        self.docker_tag = f"rsh_{self.NAME}_{self.cred.username.lower()}_{self.cred.ctype}"
+        """
+        Makes sure the shared image exists and writes this method's config files to docker_path,
+        which gets mounted into every container the method starts.
+        """
         if self.tunnel:
             self.proxychains_build()
         self.client = docker.from_env()
-        self.client.images.build(path=self.docker_path, tag=self.docker_tag)
+        self.docker_tag = build_image(self.client)
         #print("[+] Build successful")
 
     def proxychains_build(self):
         proxychains_config_path = os.path.join(self.docker_path, "proxychains.conf")
+        # Start from the stock config every time so the proxy line is only there once
+        shutil.copy(os.path.join(IMAGE_PATH, "proxychains.conf"), proxychains_config_path)
         with open(proxychains_config_path, "a", encoding="utf-8") as file:
             file.write(f"\nsocks4 {self.tunnel.ip_addr} {self.tunnel.port}")
 
-    def write_command_to_db(self, command_line, result):
-        command = Command(command_line=command_line, result=result)
-        target_model = db_session.query(Target).filter(Target.id==self.target.id).one()
-        target_model.commands.append(command)
+    def docker_volumes(self, volumes: dict) -> dict:
+        """
+        Returns container volumes with this method's config directory mounted at /rsh.
+        """
+        return {self.docker_path: {"bind": "/rsh", "mode": "ro"}, **volumes}
+
+    def write_command_to_db(self, command_line, result, sync: bool=False):
+        """
+        Queues the command for the database. With sync, waits until it has been written.
+        """
+        if isinstance(result, bytes):
+            result = result.decode(errors="replace")
+        journal.write(self.target.id, command_line, blob_store.put(result), result)
+        if sync is True:
+            journal.flush()
+
+    def write_command_log(self, command, output, cmd_time):
+        """
+        Adds a cmd/ log entry for the command, a link to its output in the blob store.
+        """
+        format_command = command.replace(" ", "_").replace(
+            "/", "_"
+        )  # replace spaces and /
+        blob_store.link(blob_store.put(output), f"{self.cmd_path}/{format_command}_{cmd_time}.gz")
+
+    def record_latency(self, command, mode, start):
+        """
+        Stores how long a command took so different execution paths can be compared.
+        """
+        latency = time.perf_counter() - start
+        self.latencies.append((command, mode, latency))
+        return latency
+
+    def wait_for_connect(self, since: int, timeout: int=None, markers: list=None, path: str=None, settle: float=None) -> bool:
+        """
+        Waits on the connect container and records the outcome. See ConnectWatcher for what
+        counts as connected.
+        """
+        if timeout is None:
+            timeout = CONNECT_TIMEOUT
+        watcher = ConnectWatcher(self.client, self.container, since, markers=markers, path=path, settle=settle)
+        result = watcher.wait(timeout)
+
+        if result == "connected":
+            self.table_instance.status = "Success"
+            db_session.commit()
+            return True
+
+        if result == "timeout":
+            print_fail(f"Failed to connect: no response after {timeout} seconds")
+        else:
+            fail_log = self.container.logs().decode("utf-8").split("\n")
+            fail_log_message = fail_log[1:-1]
+            print_fail("Failed to connect:")
+            for line in fail_log_message:
+                print(line.strip())
+        self.table_instance.status = "Failed"
         db_session.commit()
+        self.disconnect()
+        return False
 
     def connect(self):
         pass
@@ -113,9 +215,119 @@ class MethodBase:
     def run_command(self, command):
         print_fail("This method cannot run commands")
 
+    def run_batch(self, commands: list) -> list:
+        """
+        Runs several commands and returns their outputs in order. Methods that can send them in
+        a single round trip override this.
+        """
+        return [self.run_command(command, silent=True) for command in commands]
+
+    def run_cmd_script(self, commands: list, run) -> list:
+        """
+        Runs cmd commands as one script per remote execution, as few scripts as the cmd.exe
+        line limit allows, and splits the output back apart. 'run' sends a single command line
+        and returns its output.
+        """
+        outputs = []
+        for chunk in script_chunks(commands, transport.WINDOWS_COMMAND_LIMIT):
+            marker = uuid.uuid4().hex[:12]
+            script = cmd_script(chunk, marker)
+            # Compressed as a whole, the wrapper falls back to the plain script if it gets too long
+            wire_script = self.compress_command(script)
+            output = run(wire_script)
+            if wire_script != script:
+                output = self.decompress_output(script, output, wire_script)
+            outputs.extend(split_script_output(output, marker, len(chunk)))
+        return outputs
+
+    def record_batch(self, commands: list, outputs: list, mode: str, start: float) -> None:
+        """
+        Logs and stores each command of a batch as if it had been run on its own.
+        """
+        cmd_time = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.record_latency(f"batch of {len(commands)}", mode, start)
+        for command, output in zip(commands, outputs):
+            self.write_command_log(command, output, cmd_time)
+            self.write_command_to_db(command, output)
+
+    def set_compression(self, state: str, **_) -> None:
+        """
+        Turns gzip+base64 transport for commands and output on or off. Turning it on checks
+        what the target has to do its side of the work.
+        """
+        if state == "off":
+            self.compression = None
+            print_success("Compression off")
+            return
+        if self.connected is not True:
+            print_fail("Method is not connected")
+            return
+        self.compression = transport.detect(self)
+        if self.compression is None:
+            print_fail("Target has no gzip, Python or PowerShell to compress with")
+        else:
+            print_success(f"Compression on, using {self.compression} on the target")
+
+    def compress_command(self, command: str) -> str:
+        """
+        Returns the command line to send for command, wrapped if compression is on.
+        """
+        if self.compression is None:
+            return command
+        return self.compression.wrap(command)
+
+    def decompress_output(self, command: str, output: str, wire_command: str=None) -> str:
+        """
+        Decodes compressed output and records what compression saved. wire_command is what was
+        actually sent, if compress_command() wrapped the command.
+        """
+        plain = transport.unwrap(output)
+        if plain is None:
+            print_fail("Couldn't decode compressed output, keeping it as received")
+            return output
+        sent = len(wire_command or command)
+        self.record_compression(command, len(command) + len(plain.encode()), sent + len(output.encode()))
+        return plain
+
+    def record_compression(self, command: str, plain_bytes: int, wire_bytes: int) -> None:
+        """
+        Stores how many bytes a command or payload would have taken uncompressed and how many
+        actually went over the wire.
+        """
+        self.compression_stats.append((command, plain_bytes, wire_bytes))
+
     def shell(self, **_):
         print_fail("This method cannot start a shell")
 
+    def get_file(self, file_path, **_):
+        print_fail("This method cannot download files")
+
+    def get_files(self, paths: list, **kwargs) -> list:
+        """
+        Downloads several files or directories. Methods that can share one session between
+        transfers override this.
+        """
+        for path in paths:
+            self.get_file(path, **kwargs)
+        return []
+
+    def show_transfers(self, results: list) -> None:
+        """
+        Prints one row per file of a download, as returned by get_files().
+        """
+        tab = PrettyTable(["File", "Status", "Size", "Detail"], align="l")
+        for result in results:
+            tab.add_row([result["path"], result["status"], result["size"], result["detail"]])
+        print(tab)
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+        if counts.get("failed"):
+            print_fail(summary)
+        else:
+            print_success(summary)
+
     def name_generator(self) -> str:
         random_value = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
         if self.hostname:
@@ -148,6 +360,8 @@ class MethodBase:
         pass
 
     def disconnect(self):
+        # Commands still queued belong to this session
+        journal.flush()
         if self.container == None:
             return
         try:
@@ -160,6 +374,35 @@ class MethodBase:
             pass
 
 
+def image_tag(image_path=IMAGE_PATH) -> str:
+    """
+    Builds the image tag from a hash of the files the image is built from.
+    """
+    digest = hashlib.sha256()
+    for file in sorted(os.listdir(image_path)):
+        digest.update(file.encode())
+        with open(os.path.join(image_path, file), "rb") as f:
+            digest.update(f.read())
+    return f"{IMAGE_NAME}:{digest.hexdigest()[:12]}"
+
+
+def build_image(client, image_path=IMAGE_PATH) -> str:
+    """
+    Builds the shared image, unless an image for the current ./images contents already exists.
+    """
+    tag = image_tag(image_path)
+    with build_lock:
+        if tag in built_tags:
+            return tag
+        try:
+            client.images.get(tag)
+        except errors.ImageNotFound:
+            print_running("Building RedShell image...")
+            client.images.build(path=os.path.abspath(image_path), tag=tag)
+        built_tags.add(tag)
+    return tag
+
+
 def load_module(module_path):
     """Utility to automatically load modules."""
     name = os.path.split(module_path)[-1]
@@ -7,6 +7,9 @@ class BuiltinBase:
     Basic resource class. Concrete resources will inherit from this one.
     """
     builtins = []
+    # Builtins that ask before doing anything. run-all asks once for every target instead and
+    # then runs them with interactive=False, the workers must never prompt
+    CONFIRM = False
 
     # For every class that inherits from the current,
     # the class name will be added to builtins
@@ -15,15 +18,8 @@ class BuiltinBase:
         cls.builtins.append(cls)
     
     def write_to_file(self):
-        # Write command output to file with command as title
-        format_command = self.NAME.replace(" ", "_").replace(
-            "/", "_"
-        )  # replace spaces and /
-        cmd_log = f"{self.method.cmd_path}/{format_command}_{self.cmd_time}"
-
-        # Write output to cmd file
-        with open(cmd_log, "w", encoding="utf-8") as f:
-            f.write(self.output)
+        # Log output under the builtin's name
+        self.method.write_command_log(self.NAME, self.output, self.cmd_time)
 
 def load_module(module_path):
     """Utility to automatically load modules."""
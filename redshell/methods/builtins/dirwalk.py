@@ -7,7 +7,6 @@ from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.shortcuts import ProgressBar
 from prompt_toolkit.shortcuts.progress_bar import formatters
 from prompt_toolkit.styles import Style
-from redshell import config
 from redshell.output_formatter import print_success, print_running, print_fail
 from redshell.methods.builtins import BuiltinBase
 
@@ -15,19 +14,64 @@ class DirWalk(BuiltinBase):
     NAME = "dirwalk"
     META = "Performs recursive dir walk starting at target directory"
     TARGET_OS = ["Windows", "Linux"]
-    OPTIONS = {"--target_dir": "Directory to act as root for dirwalk. USE FULL PATH!", "--depth": "Depth of directories to search"}
+    OPTIONS = {
+        "--target_dir": "Directory to act as root for dirwalk. USE FULL PATH!",
+        "--depth": "Depth of directories to search",
+        "--mode": "'bulk' lists everything in one command (default), 'bfs' lists one directory at a time for restricted shells",
+    }
+
+    # Paths handed to the file tracker at a time while a bulk listing streams in
+    BATCH_SIZE = 500
 
     def __init__(self, method) -> None:
         self.method = method
 
-    def run(self, target_dir, depth, **_):
+    def run(self, target_dir, depth, mode="bulk", **_):
         filesystem = self.method.run_command("pwd", silent=True, record=False)
         if filesystem.startswith("/"):
             if not target_dir.endswith("/"):
                 target_dir += "/"
-            self._linux_dir_handler(target_dir, int(depth))
+            if mode == "bfs":
+                self._linux_dir_handler(target_dir, int(depth))
+            else:
+                self._linux_bulk_handler(target_dir, int(depth))
         else:
-            self._windows_dir_handler(target_dir, int(depth))
+            if mode == "bfs":
+                self._windows_dir_handler(target_dir, int(depth))
+            else:
+                self._windows_bulk_handler(target_dir, int(depth))
+
+    def _stream_lines(self, command):
+        """
+        Yields command output line by line, as it arrives if the method can stream.
+        """
+        if hasattr(self.method, "stream_command"):
+            yield from self.method.stream_command(command)
+        else:
+            yield from (self.method.run_command(command, silent=True) or "").split("\n")
+
+    def _linux_bulk_handler(self, target_dir, depth: int):
+        print_running(f"Listing {target_dir} {str(depth)} levels deep in one command...")
+        # Files first and directories (marked with a trailing /) last, so the exit status
+        # comes from sed and errors on unreadable directories don't throw away the output
+        command = (
+            f"find {target_dir} -mindepth 1 -maxdepth {depth} ! -type d 2>/dev/null ; "
+            f"find {target_dir} -mindepth 1 -maxdepth {depth} -type d 2>/dev/null | sed \"'s|$|/|'\""
+        )
+        count = 0
+        batch = []
+        for line in self._stream_lines(command):
+            line = line.strip().replace("//", "/")
+            if not line.startswith(target_dir):
+                continue
+            batch.append(line)
+            if len(batch) >= self.BATCH_SIZE:
+                self._linux_dir_writer(batch)
+                count += len(batch)
+                batch = []
+        self._linux_dir_writer(batch)
+        count += len(batch)
+        print_success(f"Recorded {count} paths under {target_dir}")
 
     def _linux_dir_handler(self, target_dir, depth: int):
         current_depth = 0
@@ -83,17 +127,36 @@ class DirWalk(BuiltinBase):
         return output_list
     
     def _linux_dir_writer(self, contents):
-        configuration = config.read_config()
-        op_path = configuration["op_path"]
-        file_tracker = f"{op_path}{self.method.host}/filesystem.txt"
-        if not os.path.exists(file_tracker):
-            os.mknod(file_tracker)
-        with open(file_tracker, "r+") as file:
-            original_file = file.read()
-            for line in contents:
-                if line not in original_file and not line.endswith("Permission denied"):
-                    #print(f"Writing {line}")
-                    file.write(f"{line}\n")
+        self.method.target.filesystem.add(line for line in contents if not line.endswith("Permission denied"))
+
+    def _windows_bulk_handler(self, target_dir, depth):
+        print_running(f"Listing {target_dir} {str(depth)} levels deep in bulk...")
+        root = target_dir.rstrip("\\")
+        prefix = f"{root}\\"
+        # 'dir "C:"' would list the current directory of C:, so keep the \ for drive roots
+        if root.endswith(":"):
+            root = prefix
+        root_depth = prefix.count("\\") - 1
+        count = 0
+        # 'dir' can't limit depth, so list everything and drop what is too deep here
+        # Directories and files are listed separately so directories can get their trailing \
+        for attributes, suffix in (("-d", ""), ("d", "\\")):
+            command = f'dir /s /b /a:{attributes} "{root}"'
+            batch = []
+            for line in self._stream_lines(command):
+                line = line.strip()
+                if not line.lower().startswith(prefix.lower()):
+                    continue
+                if line.count("\\") - root_depth > depth:
+                    continue
+                batch.append(f"{line}{suffix}")
+                if len(batch) >= self.BATCH_SIZE:
+                    self._windows_dir_writer(batch)
+                    count += len(batch)
+                    batch = []
+            self._windows_dir_writer(batch)
+            count += len(batch)
+        print_success(f"Recorded {count} paths under {target_dir}")
 
     def _windows_dir_handler(self, target_dir, depth):
         current_depth = 0
@@ -183,17 +246,7 @@ class DirWalk(BuiltinBase):
         return result_list
     
     def _windows_dir_writer(self, contents):
-        configuration = config.read_config()
-        op_path = configuration["op_path"]
-        file_tracker = f"{op_path}{self.method.host}/filesystem.txt"
-        if not os.path.exists(file_tracker):
-            os.mknod(file_tracker)
-        with open(file_tracker, "r+") as file:
-            original_file = file.read()
-            for line in contents:
-                if line not in original_file and not line.endswith("denied."):
-                    #print(f"Writing {line}")
-                    file.write(f"{line}\n")
+        self.method.target.filesystem.add(line for line in contents if not line.endswith("denied."))
 
 # Create custom key bindings first.
 kb = KeyBindings()
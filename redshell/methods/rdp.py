@@ -13,6 +13,7 @@ class RDP(MethodBase):
     NAME = "rdp"
     META = "xFreeRDP client run in Docker through X11"
     TARGET_OS = ["Windows"]
+    RUNS_COMMANDS = False
 
     def __init__(self, target, cred, tunnel, table_instance) -> None:
         self.target = target
@@ -42,15 +43,14 @@ class RDP(MethodBase):
         self.collect_path = f"{target.op_path}/files"
         self.docker_path = os.path.join(target.op_path, f"docker/rdp/{self.cred.username}_{self.cred.ctype}")
 
-        paths = [self.cmd_path, self.collect_path, self.docker_path]
-        for path in paths:
-            if not os.path.exists(path):
-                os.makedirs(path)
+        # Created on first use by setup()
+        self.paths = [self.cmd_path, self.collect_path, self.docker_path]
+        self.ready = False
 
-        self.docker_build()
-
-    def connect(self, **_):
+    def connect(self, timeout=None, **_):
+        self.setup()
         self.container_name = self.name_generator()
+        since = int(time.time())
         # Password
         if self.cred.ctype == 'password':
             command_line = f"xfreerdp /v:{self.ip_addr} /u:{self.cred.username} /p:{self.cred.cred} +clipboard /cert:ignore /log-level:DEBUG /dynamic-resolution"
@@ -72,31 +72,15 @@ class RDP(MethodBase):
             remove=False,
             name=self.container_name,
             network_mode="host",
-            volumes={self.collect_path: {"bind": "/data", "mode": "rw"}, "/tmp/.X11-unix": {"bind": "/tmp/.X11-unix", "mode": "rw"}},
+            volumes=self.docker_volumes({self.collect_path: {"bind": "/data", "mode": "rw"}, "/tmp/.X11-unix": {"bind": "/tmp/.X11-unix", "mode": "rw"}}),
         )
 
-        # Check for container to be successful or not
-        while True:
-            time.sleep(1)
-            # Unset X11 access rules
-            xhost_unset_output = subprocess.run(["xhost", "-si:localuser:root"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            # Check container status
-            self.container.reload()
-            if self.container.status == "exited":
-                fail_log = self.container.logs().decode("utf-8").split("\n")
-                fail_log_message = fail_log[1:-1]
-                print("[!] Failed to connect:")
-                for line in fail_log_message:
-                    print(line.strip())
-                self.table_instance.status = "Failed"
-                db_session.commit()
-                self.disconnect()
-                break
-            elif self.container.status == "running":
-                self.connected = True
-                self.table_instance.status = "Success"
-                db_session.commit()
-                break
+        # xfreerdp has no reliable ready message, so connected means it didn't die right away
+        connected = self.wait_for_connect(since, timeout, settle=1)
+        # Unset X11 access rules
+        xhost_unset_output = subprocess.run(["xhost", "-si:localuser:root"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if connected:
+            self.connected = True
 
     def run_command(self, command: str, silent: bool=False, raw: bool=False, record: bool=True):
         pass
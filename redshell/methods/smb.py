@@ -6,7 +6,8 @@ import subprocess
 import select
 import sys
 import ntpath
-import pathlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import pexpect
 from datetime import datetime
 import docker
@@ -14,7 +15,13 @@ from prompt_toolkit import prompt
 from prompt_toolkit.completion import NestedCompleter
 from redshell.methods import MethodBase
 from redshell.rshcompleters import BuiltinCompleter
+from redshell.output_formatter import print_success, print_running, print_fail
 from redshell.database import db_session
+from redshell.session import AttachedSession, SessionError
+from redshell import collection
+
+# Shares downloaded side by side by get_files(), each over its own smbclient session
+SMB_WORKERS = 4
 
 class SMB(MethodBase):
     NAME = "smb"
@@ -30,6 +37,10 @@ class SMB(MethodBase):
         self.table_instance = table_instance
         self.container = None
         self.connected = False
+        # Live smbexec shell of the connect container, reused by run_command
+        self.session = None
+        self.latencies = []
+        self.compression_stats = []
 
         self.actions = NestedCompleter.from_nested_dict({
             "show": {
@@ -38,6 +49,14 @@ class SMB(MethodBase):
                 },
                 "settings": None,
                 "tunnels": None,
+                "latency": None,
+                "compression": None,
+            },
+            "set": {
+                "compression": {
+                    "on",
+                    "off",
+                },
             },
             "connect": None,
             "shell": None,
@@ -52,15 +71,14 @@ class SMB(MethodBase):
         self.collect_path = f"{target.op_path}/files"
         self.docker_path = os.path.join(target.op_path, f"docker/smb/{self.cred.username}_{self.cred.ctype}")
 
-        paths = [self.cmd_path, self.collect_path, self.docker_path]
-        for path in paths:
-            if not os.path.exists(path):
-                os.makedirs(path)
-
-        self.docker_build()
+        # Created on first use by setup()
+        self.paths = [self.cmd_path, self.collect_path, self.docker_path]
+        self.ready = False
 
-    def connect(self, **_):
+    def connect(self, timeout=None, **_):
+        self.setup()
         self.container_name = self.name_generator()
+        since = int(time.time())
 
         # Password
         if self.cred.ctype == 'password':
@@ -81,67 +99,42 @@ class SMB(MethodBase):
             stdin_open=True,
             remove=False,
             name=self.container_name,
-            volumes={self.collect_path: {"bind": "/data", "mode": "rw"}},
+            volumes=self.docker_volumes({self.collect_path: {"bind": "/data", "mode": "rw"}}),
         )
 
-        # Check for container to be successful or not
-        while True:
-            time.sleep(1)
-            self.container.reload()
-            if self.container.status == "exited":
-                fail_log = self.container.logs().decode("utf-8").split("\n")
-                fail_log_message = fail_log[1:-1]
-                print("[!] Failed to connect:")
-                for line in fail_log_message:
-                    print(line.strip())
-                self.table_instance.status = "Failed"
-                db_session.commit()
-                self.disconnect()
-                break
-            elif self.container.status == "running":
-                self.connected = True
-                self.table_instance.status = "Success"
-                db_session.commit()
-                break
-
-    def run_command(self, command: str, silent: bool=False, proxy=False) -> str:
+        # smbexec prints this once authenticated and ready for commands
+        if self.wait_for_connect(since, timeout, markers=["Launching semi-interactive shell"]):
+            self.connected = True
+            self.session = AttachedSession(self.container_name)
+
+    def run_command(self, command: str, silent: bool=False, record: bool=True, proxy=False, session: bool=True) -> str:
         if self.connected is True:
             cmd_time = datetime.now().strftime("%Y%m%d-%H%M%S")
-            # Password
-            if self.cred.ctype == 'password':
-                command_line = f"python /usr/bin/smbexec.py {self.cred.username}:{self.cred.cred}@{self.ip_addr}"
-            elif self.cred.ctype == "nthash":
-                command_line = f"python /usr/bin/smbexec.py -hashes :{self.cred.cred} {self.cred.username}@{self.ip_addr}"
-
-            # Set for proxychains
-            if self.tunnel is not None:
-                command_line = f"proxychains {command_line}"
-            
-            smb_cmd = f"docker run --rm -it -v {self.collect_path}:/data {self.docker_tag} {command_line}"
+            start = time.perf_counter()
 
-            smb_docker = pexpect.spawn(smb_cmd)
+            wire_command = self.compress_command(command)
 
-            # Handle SFTP client commands
-            smb_docker.expect("C:\\\\Windows\\\\system32>")
-            smb_docker.sendline(f"{command}")
-            smb_docker.expect("C:\\\\Windows\\\\system32>")
-            smb_docker.isalive()
-            smb_docker.close()
+            output = None
+            # Queue the command on the already authenticated smbexec shell
+            if session is True and self.session is not None:
+                mode = "session"
+                try:
+                    output = self.session.run(wire_command)
+                except SessionError as err:
+                    print_fail(f"{err}, falling back to one-shot smbexec")
+            if output is None:
+                mode = "oneshot"
+                output = self._run_oneshot(wire_command)
+            self.record_latency(command, mode, start)
+            if wire_command != command:
+                output = self.decompress_output(command, output, wire_command)
 
-            # Write command output to file with command as title
-            format_command = command.replace(" ", "_").replace(
-                "/", "_"
-            )  # replace spaces and /
-            cmd_log = f"{self.cmd_path}/{format_command}_{cmd_time}"
+            # Log command output with command as title
+            if record is True:
+                self.write_command_log(command, output, cmd_time)
 
-            # Format output, get rid of command text
-            output = smb_docker.before.decode().split("\n", 1)[1].strip()
-            # Prevent extra newlines when written to file
-            output = output.replace("\r\r", "")
-
-            # Write command output to file
-            with open(cmd_log, "w", encoding="utf-8") as f:
-                f.write(output)
+            # Commit to database
+            self.write_command_to_db(command, output)
 
             # If used by shell() or builtin, just return output
             if silent is True:
@@ -151,8 +144,72 @@ class SMB(MethodBase):
         else:
             print("[!] Method is not connected")
 
+    def run_batch(self, commands: list) -> list:
+        """
+        Runs cmd commands as one script in a single remote execution and returns their outputs
+        in order.
+        """
+        if self.connected is not True:
+            print_fail("Method is not connected")
+            return []
+        start = time.perf_counter()
+
+        outputs = None
+        if self.session is not None:
+            mode = "session"
+            try:
+                outputs = self.run_cmd_script(commands, lambda script: self.session.run(_smbexec_line(script)))
+            except SessionError as err:
+                print_fail(f"{err}, falling back to one-shot smbexec")
+        if outputs is None:
+            mode = "oneshot"
+            outputs = self.run_cmd_script(commands, lambda script: self._run_oneshot(_smbexec_line(script)))
+        self.record_batch(commands, outputs, mode, start)
+        return outputs
+
+    def _run_oneshot(self, command) -> str:
+        """
+        Runs a command in its own smbexec container, authenticating from scratch. Given a list
+        of commands, runs all of them in the same container and returns a list of outputs.
+        """
+        # Password
+        if self.cred.ctype == 'password':
+            command_line = f"python /usr/bin/smbexec.py {self.cred.username}:{self.cred.cred}@{self.ip_addr}"
+        elif self.cred.ctype == "nthash":
+            command_line = f"python /usr/bin/smbexec.py -hashes :{self.cred.cred} {self.cred.username}@{self.ip_addr}"
+
+        # Set for proxychains
+        if self.tunnel is not None:
+            command_line = f"proxychains {command_line}"
+        
+        smb_cmd = f"docker run --rm -it -v {self.docker_path}:/rsh:ro -v {self.collect_path}:/data {self.docker_tag} {command_line}"
+
+        smb_docker = pexpect.spawn(smb_cmd)
+
+        # smbexec can't chain commands, so they go one prompt at a time
+        commands = command if isinstance(command, list) else [command]
+        outputs = []
+        smb_docker.expect("C:\\\\Windows\\\\system32>")
+        for line in commands:
+            smb_docker.sendline(f"{line}")
+            smb_docker.expect("C:\\\\Windows\\\\system32>")
+
+            # Format output, get rid of command text
+            output = smb_docker.before.decode().split("\n", 1)[1].strip()
+            # Prevent extra newlines when written to file
+            outputs.append(output.replace("\r\r", ""))
+        smb_docker.isalive()
+        smb_docker.close()
+
+        if isinstance(command, list):
+            return outputs
+        return outputs[0]
+
     def shell(self, **kwargs):
         if self.connected is True:
+            # Hand the terminal over to the user, run_command will reattach when needed
+            if self.session is not None:
+                self.session.close()
             self.container.reload()
             # Get container running again if shell was used and exited
             if self.container.status != 'running':
@@ -202,47 +259,167 @@ class SMB(MethodBase):
             print("[!] Method is not connected")
 
     def get_file(self, file_path, **_):
-        if self.connected is True:
-            #cmd_time = datetime.now().strftime("%Y%m%d-%H%M%S")
-            # Split file path to get remote dir and file
-            remote_dir, filename = ntpath.split(file_path)
-            # Get drive letter and path
-            drive, path = ntpath.splitdrive(file_path)
-            # Change from Windows to Unix file path
-            new_local_dir = pathlib.PureWindowsPath(remote_dir).as_posix()
-            new_local_dir = new_local_dir.replace(":", "").lower()
-            collect_file_path = f"{self.collect_path}/{new_local_dir}"
-            # Create local dir for files to match target filesystem
-            if not os.path.exists(collect_file_path):
-                os.makedirs(collect_file_path)
-            
-            if self.cred.ctype == "password":
-                command_line = f"python /usr/bin/smbclient.py {self.cred.username}:{self.cred.cred}@{self.ip_addr}"
-            elif self.cred.ctype == "nthash":
-                command_line = f"python /usr/bin/smbclient.py -hashes :{self.cred.cred} {self.cred.username}@{self.ip_addr}"
-
-            # Set for proxychains
-            if self.tunnel is not None:
-                command_line = f"proxychains {command_line}"
-
-            smb_cmd = f"docker run --rm -it -v {collect_file_path}:/data {self.docker_tag} {command_line}"
-
-            smb_docker = pexpect.spawn(smb_cmd)
-
-            # Handle SFTP client commands
-            smb_docker.expect("# ")
-            smb_docker.sendline(f"use {drive[:-1]}$")
-            smb_docker.expect("# ")
-            smb_docker.sendline(f"get {path[1:]}")
-            # List of possible responses
-            response = smb_docker.expect(["[-]", "# "])
-            if response == 0:
-                print("[!] Error")
-                print(smb_docker.before.decode().strip()+smb_docker.after.decode().strip())
-            elif response == 1:
-                print(f"[+] Successfully downloaded {file_path}")
-            smb_docker.isalive()
-            smb_docker.close()
+        return self.get_files([file_path])
 
-        else:
-            print("[!] Method is not connected")
+    def get_files(self, paths: list, workers: int=SMB_WORKERS, **_) -> list:
+        """
+        Downloads files, wildcards and directory trees (recursively) into the collection dir.
+        Each share gets one smbclient session for all of its files, shares download side by side.
+        Files whose SHA256 on the target matches the collected copy aren't downloaded again.
+        """
+        if self.connected is not True:
+            print_fail("Method is not connected")
+            return []
+        self.setup()
+        print_running(f"Listing and hashing {', '.join(paths)} on target...")
+
+        listing = self._list_remote(paths)
+        if not listing:
+            print_fail("No matching files on target")
+            return []
+
+        results = {}
+        shares = {}
+        for remote_path, size, digest in listing:
+            local_path = collection.local_path(self.collect_path, remote_path)
+            # smbclient can't resume, anything but an identical copy is downloaded again
+            if digest and self.target.collection.sha256(local_path) == digest:
+                results[remote_path] = {"path": remote_path, "status": "skipped", "size": size, "detail": "unchanged"}
+                continue
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            share, share_path = _split_share(remote_path)
+            shares.setdefault(share, []).append((remote_path, share_path, size, digest))
+
+        if shares:
+            print_running(f"Downloading {sum(len(jobs) for jobs in shares.values())} files from {len(shares)} shares...")
+            errors_by_path = {}
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(shares)))) as executor:
+                for share_errors in executor.map(self._run_smbclient, shares.keys(), shares.values()):
+                    errors_by_path.update(share_errors)
+
+            for jobs in shares.values():
+                for remote_path, _, size, digest in jobs:
+                    local_path = collection.local_path(self.collect_path, remote_path)
+                    if remote_path in errors_by_path or not os.path.isfile(local_path) or os.path.getsize(local_path) != size:
+                        detail = errors_by_path.get(remote_path, "incomplete download")
+                        results[remote_path] = {"path": remote_path, "status": "failed", "size": size, "detail": detail}
+                    # The file can change between hashing and downloading
+                    elif digest and self.target.collection.sha256(local_path) != digest:
+                        results[remote_path] = {"path": remote_path, "status": "failed", "size": size, "detail": "SHA256 mismatch"}
+                    else:
+                        results[remote_path] = {"path": remote_path, "status": "downloaded", "size": size, "detail": ""}
+
+        self.target.collection.save()
+        results = [results[remote_path] for remote_path, _, _ in listing]
+        self.show_transfers(results)
+        return results
+
+    def _list_remote(self, paths: list) -> list:
+        """
+        Expands wildcards and directories on the target through the smbexec shell and returns
+        (path, size, sha256) for every file below them.
+        """
+        output = self.run_command(collection.windows_listing(paths), silent=True, record=False) or ""
+        return collection.parse_listing(output)
+
+    def _run_smbclient(self, share: str, jobs: list) -> dict:
+        """
+        Fetches files from one share in a single smbclient session, reporting each file as it
+        finishes. Returns the error of every file that failed.
+        """
+        if self.cred.ctype == "password":
+            command_line = f"python /usr/bin/smbclient.py {self.cred.username}:{self.cred.cred}@{self.ip_addr}"
+        elif self.cred.ctype == "nthash":
+            command_line = f"python /usr/bin/smbclient.py -hashes :{self.cred.cred} {self.cred.username}@{self.ip_addr}"
+
+        # Set for proxychains
+        if self.tunnel is not None:
+            command_line = f"proxychains {command_line}"
+
+        # smbclient saves into its working dir, so change it whenever the target dir changes
+        input_name = f"smbclient_{uuid.uuid4().hex}"
+        input_path = os.path.join(self.docker_path, input_name)
+        gets = {}
+        with open(input_path, "w", encoding="utf-8") as input_file:
+            input_file.write(f"use {share}\n")
+            local_dir = None
+            for remote_path, share_path, _, _ in jobs:
+                container_dir = "/data/" + os.path.relpath(os.path.dirname(collection.local_path(self.collect_path, remote_path)), self.collect_path)
+                if container_dir != local_dir:
+                    input_file.write(f"lcd {container_dir}\n")
+                    local_dir = container_dir
+                input_file.write(f"get {share_path}\n")
+                gets[f"get {share_path}"] = remote_path
+
+        errors_by_path = {}
+        container = self.client.containers.run(
+            self.docker_tag,
+            f"{command_line} -inputfile /rsh/{input_name}",
+            detach=True,
+            # Without a TTY stdout is block buffered while stderr isn't, and errors have to stay
+            # in order with the command echoes they belong to
+            environment={"PYTHONUNBUFFERED": "1"},
+            volumes=self.docker_volumes({self.collect_path: {"bind": "/data", "mode": "rw"}}),
+        )
+        try:
+            # Every command is echoed as '# command', anything after it until the next one is its output
+            current = None
+            for line in _container_lines(container):
+                line = line.strip()
+                if line.startswith("# "):
+                    if current in gets and gets[current] not in errors_by_path:
+                        print_success(f"Downloaded {gets[current]}")
+                    current = line[2:].strip()
+                elif line.startswith("[-]") and current is not None:
+                    error = line[3:].strip()
+                    # Nothing gets through a share that can't be opened
+                    if current.startswith("use "):
+                        errors_by_path.update({remote_path: error for remote_path, _, _, _ in jobs})
+                    elif current in gets:
+                        errors_by_path[gets[current]] = error
+                        print_fail(f"Failed {gets[current]}: {error}")
+            if current in gets and gets[current] not in errors_by_path:
+                print_success(f"Downloaded {gets[current]}")
+        finally:
+            container.remove(force=True)
+            os.remove(input_path)
+        return errors_by_path
+
+    def disconnect(self):
+        if self.session is not None:
+            self.session.close()
+        super().disconnect()
+
+def _split_share(remote_path: str) -> tuple:
+    """
+    Splits a Windows path into the share it is reached through and the path inside it, using
+    the admin share for drive letters, e.g. C:\\Users\\bob -> (C$, \\Users\\bob).
+    """
+    drive, path = ntpath.splitdrive(remote_path)
+    if drive.startswith("\\\\"):
+        share = drive.split("\\")[-1]
+    else:
+        share = f"{drive[:-1]}$"
+    return share, path
+
+def _container_lines(container):
+    """
+    Yields the container's output line by line as it runs.
+    """
+    buffer = ""
+    for chunk in container.logs(stream=True, follow=True):
+        buffer += chunk.decode(errors="replace")
+        *lines, buffer = buffer.split("\n")
+        yield from lines
+    if buffer:
+        yield buffer
+
+def _smbexec_line(command: str) -> str:
+    """
+    smbexec echoes every line into a batch file it then runs, so cmd metacharacters are escaped
+    to end up in the file instead of splitting the echo.
+    """
+    # Carets first, or the ones added for the other characters would be doubled
+    for char in "^&|<>":
+        command = command.replace(char, f"^{char}")
+    return command
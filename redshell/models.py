@@ -1,7 +1,8 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Table, DateTime
+from sqlalchemy import Column, ForeignKey, Integer, String, Table, DateTime, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
+from .blobs import blob_store
 
 class Target(Base):
     __tablename__ = 'target_t'
@@ -18,9 +19,17 @@ class Target(Base):
     credentials = relationship("Credential", secondary="target_cred", backref='targets')
     methods = relationship("Method", back_populates="target")
     commands = relationship("Command", back_populates="target")
+    paths = relationship("FilesystemPath", back_populates="target")
+    ports = relationship("OpenPort", back_populates="target")
+    collected = relationship("CollectedFile", back_populates="target")
 
 class Credential(Base):
     __tablename__ = 'credential_t'
+    # Matches the duplicate check in CredentialsController.append. Most credentials have no
+    # domain and NULLs never collide in a unique index, so it's compared as ''
+    __table_args__ = (
+        Index("ix_credential_key", "username", "ctype", "cred", func.coalesce(text("domain"), ""), "origin", unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     username = Column(String)
@@ -34,13 +43,19 @@ class Credential(Base):
 
 class Method(Base):
     __tablename__ = "method_t"
+    # Matches the duplicate check in MethodsController.append. Most methods have no tunnel and
+    # NULLs never collide in a unique index, so it's compared as -1
+    __table_args__ = (
+        Index("ix_method_key", "target_id", "cred_id", "method_type", func.coalesce(text("tunnel_id"), -1), unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     method_type = Column(String)
     status = Column(String)
 
+    # target_id lookups are served by ix_method_key
     target_id = Column(String, ForeignKey("target_t.id"), nullable=False)
-    cred_id = Column(Integer, ForeignKey("credential_t.id"), nullable=False)
+    cred_id = Column(Integer, ForeignKey("credential_t.id"), nullable=False, index=True)
     tunnel_id = Column(Integer, ForeignKey("tunnel_t.id"), nullable=True)
     target = relationship("Target", back_populates="methods")
     credential = relationship("Credential", back_populates="methods")
@@ -48,6 +63,8 @@ class Method(Base):
 
 class Tunnel(Base):
     __tablename__ = 'tunnel_t'
+    # Matches the duplicate check in TunnelsController.append
+    __table_args__ = (Index("ix_tunnel_unique", "ip_addr", "port", "tunnel_type", unique=True),)
 
     id = Column(Integer, primary_key=True)
     ip_addr = Column(String)
@@ -58,18 +75,73 @@ class Tunnel(Base):
 
 class Command(Base):
     __tablename__ = "command_t"
+    # A target's commands in time order, also serves plain target_id lookups
+    __table_args__ = (Index("ix_command_target_time", "target_id", "time_run"),)
 
     id = Column(Integer, primary_key=True)
     command_line = Column(String)
+    # Output is kept in the blob store, result only holds output of rows from older versions
     result = Column(String)
-    time_run = Column(DateTime(timezone=True), server_default=func.now())
+    result_hash = Column(String, index=True)
+    time_run = Column(DateTime(timezone=True), server_default=func.now(), index=True)
 
     target_id = Column(String, ForeignKey("target_t.id"), nullable=False)
     target = relationship("Target", back_populates="commands")
 
+    @property
+    def output(self) -> str:
+        """
+        The command's output, only read from the blob store when asked for.
+        """
+        if self.result_hash is not None:
+            return blob_store.get(self.result_hash)
+        return self.result
+
+class FilesystemPath(Base):
+    __tablename__ = "filesystem_t"
+    # One row per path per target, also serves as the index for prefix lookups
+    __table_args__ = (UniqueConstraint("target_id", "path"),)
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False)
+
+    target_id = Column(String, ForeignKey("target_t.id"), nullable=False)
+    target = relationship("Target", back_populates="paths")
+
+class OpenPort(Base):
+    __tablename__ = "port_t"
+    # Rescanning a host only updates when its ports were last seen open
+    __table_args__ = (UniqueConstraint("target_id", "host", "port"),)
+
+    id = Column(Integer, primary_key=True)
+    # Host and port reachable from the target the scan ran on
+    host = Column(String, nullable=False)
+    port = Column(Integer, nullable=False)
+    time_seen = Column(DateTime(timezone=True), server_default=func.now())
+
+    target_id = Column(String, ForeignKey("target_t.id"), nullable=False)
+    target = relationship("Target", back_populates="ports")
+
+class CollectedFile(Base):
+    __tablename__ = "collected_t"
+    # Hash of a file in the target's collection dir, valid while size and mtime still match
+    __table_args__ = (UniqueConstraint("target_id", "path"),)
+
+    id = Column(Integer, primary_key=True)
+    # Relative to the collection dir
+    path = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    mtime_ns = Column(Integer, nullable=False)
+    sha256 = Column(String, nullable=False)
+
+    target_id = Column(String, ForeignKey("target_t.id"), nullable=False)
+    target = relationship("Target", back_populates="collected")
+
 target_cred_table = Table(
     "target_cred",
     Base.metadata,
     Column("target_id", String, ForeignKey("target_t.id"), primary_key=True),
-    Column("cred_id", Integer, ForeignKey("credential_t.id"), primary_key=True)
+    Column("cred_id", Integer, ForeignKey("credential_t.id"), primary_key=True),
+    # The primary key covers lookups by target, this one covers Credential.targets
+    Index("ix_target_cred_cred_id", "cred_id"),
 )
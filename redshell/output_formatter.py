@@ -10,4 +10,10 @@ def print_running(message):
 
 def print_fail(message):
     #print(f"{Style.BRIGHT}[{Fore.RED}!{Fore.RESET}]{Style.RESET_ALL} {message}")
-    print(f"{Style.BRIGHT}{Fore.RED}[!]{Style.RESET_ALL} {message}")
\ No newline at end of file
+    print(f"{Style.BRIGHT}{Fore.RED}[!]{Style.RESET_ALL} {message}")
+
+def print_progress(message, done, total, width=30):
+    # Redrawn in place on every call, print() once afterwards to move past it
+    filled = int(width * done / total) if total else width
+    percent = 100 * done / total if total else 100
+    print(f"\r{Style.BRIGHT}{Fore.BLUE}[*]{Style.RESET_ALL} {message} [{'#' * filled}{'-' * (width - filled)}] {percent:5.1f}%", end="", flush=True)
@@ -1,15 +1,27 @@
 import os
 import docker
-from sqlalchemy.exc import IntegrityError
+from prettytable import PrettyTable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import event, select, insert, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.completion import NestedCompleter
-from collections import UserDict, UserList
+from collections import UserDict, UserList, OrderedDict
 from redshell import config
-from .database import Base, db_session, engine
+from .database import Base, db_session, engine, migrate
 from .models import Target, Credential, Tunnel, Command
+from .journal import journal
+from . import search
 from .methods import MethodsController
+from .methods.builtins import BuiltinBase
+from .filesystem import FilesystemTracker
+from .collection import HashIndex
 from .output_formatter import print_success, print_running, print_fail
 from .rshcompleters import AppendTargetCompleter, TargetCompleter, MethodCompleter, CredentialCompleter
 
+# Most TargetController instances kept loaded at once, see TargetsController.evict
+TARGET_CACHE_SIZE = 256
+
 class RSH:
     def __init__(self) -> None:
         self.op_path = ''
@@ -26,11 +38,25 @@ class RSH:
                 'target'
             },
             'set': {
-                'target': TargetCompleter()
+                'target': TargetCompleter(self)
             },
             'unset': {
                 'target'
             },
+            'connect': {
+                '--all',
+                '--workers',
+            },
+            'run-all': {
+                '--targets',
+                '--builtin',
+                '--workers',
+            },
+            'search': {
+                '--target',
+                '--limit',
+                '--raw',
+            },
             'exit': None,
         })
 
@@ -46,6 +72,8 @@ class RSH:
 
         # Start SQLite database
         Base.metadata.create_all(bind=engine)
+        migrate()
+        search.create_index()
         self.targets = TargetsController(self.op_path)
 
     @property
@@ -63,29 +91,263 @@ class RSH:
                     rsh_containers[method] = method.container
         return rsh_containers
 
+    def connect_all(self, targets: list=None, workers: int=8, **_) -> dict:
+        """
+        Connects every method of the given targets (all targets if none are given) at the same
+        time, with at most 'workers' connects in flight. Returns a dict of method -> connected.
+        """
+        if not targets:
+            targets = list(self.targets.names())
+
+        methods = []
+        for target in targets:
+            try:
+                methods.extend(self.targets[target].methods)
+            except KeyError:
+                print_fail(f"No target named {target}")
+        methods = [method for method in methods if not method.connected]
+        if not methods:
+            print_fail("No unconnected methods to connect")
+            return {}
+
+        _load_rows(methods)
+
+        print_running(f"Connecting {len(methods)} methods with {workers} workers...")
+        results = {}
+        with patch_stdout(), ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_connect_method, method): method for method in methods}
+            for i, future in enumerate(as_completed(futures), start=1):
+                method = futures[future]
+                name = f"{method.hostname or method.ip_addr} {method.NAME} ({method.cred.username})"
+                try:
+                    results[method] = future.result()
+                except Exception as exc:
+                    print_fail(f"{name}: {exc}")
+                    method.table_instance.status = "Failed"
+                    results[method] = False
+                if results[method]:
+                    print_success(f"[{i}/{len(methods)}] {name} connected")
+                else:
+                    print_fail(f"[{i}/{len(methods)}] {name} failed")
+
+        # Statuses were set by the workers on rows owned by this thread's session
+        db_session.commit()
+        connected = sum(1 for result in results.values() if result)
+        print_running(f"{connected}/{len(methods)} methods connected")
+        return results
+
+    def run_all(self, command: str=None, targets: list=None, builtin: str=None, workers: int=8, **kwargs) -> dict:
+        """
+        Runs a command, or a builtin, on every given target (all targets if none are given)
+        through one connected method per target, with at most 'workers' running at once.
+        Returns a dict of host -> output.
+
+        Builtins run with interactive=False, so they never prompt from a worker thread. One
+        that asks before running (CONFIRM) is confirmed here once for every target.
+        """
+        if not targets:
+            targets = list(self.targets.names())
+
+        # First connected method of each target that can run commands
+        methods = []
+        for target in targets:
+            try:
+                target_methods = self.targets[target].methods
+            except KeyError:
+                print_fail(f"No target named {target}")
+                continue
+            for method in target_methods:
+                if method.connected and method.RUNS_COMMANDS:
+                    methods.append(method)
+                    break
+            else:
+                print_fail(f"{target} has no connected method that can run commands")
+        if not methods:
+            return {}
+
+        _load_rows(methods)
+
+        if builtin is not None:
+            builtin_class = {builtin_class.NAME: builtin_class for builtin_class in BuiltinBase.builtins}.get(builtin)
+            if builtin_class is None:
+                print_fail("No builtin by that name")
+                return {}
+            if builtin_class.CONFIRM and input(f"Run {builtin} on {len(methods)} targets? (y/N) ") != "y":
+                return {}
+
+        print_running(f"Running on {len(methods)} targets with {workers} workers...")
+        results = {}
+        with patch_stdout(), ThreadPoolExecutor(max_workers=workers) as executor:
+            if builtin is not None:
+                futures = {executor.submit(_run_builtin, method, builtin, interactive=False, **kwargs): method for method in methods}
+            else:
+                futures = {executor.submit(_run_method_command, method, command): method for method in methods}
+            for future in as_completed(futures):
+                method = futures[future]
+                host = method.hostname or method.ip_addr
+                try:
+                    results[host] = future.result()
+                except Exception as exc:
+                    print_fail(f"{host}: {exc}")
+                    continue
+                if builtin is None:
+                    print_success(f"{host} ({method.NAME}):")
+                    print(results[host])
+        # Everything run is in the database by the time results are returned
+        journal.flush()
+        # Builtins committed through their worker threads' sessions, reload what this one holds
+        db_session.expire_all()
+
+        if builtin is None and len(results) > 1:
+            self.show_merged(results)
+        return results
+
+    def search(self, query: str, target: str=None, limit: int=20, raw: bool=False, **_) -> list:
+        """
+        Searches the output of every command run so far, see search.search. Returns
+        (target, command line, time run, snippet) rows, best matches first.
+        """
+        target_id = None
+        if target is not None:
+            try:
+                target_id = self.targets[target].id
+            except KeyError:
+                print_fail(f"No target named {target}")
+                return []
+        # Everything run so far should be searchable
+        journal.flush()
+        try:
+            return search.search(query, target_id=target_id, limit=limit, raw=raw)
+        except OperationalError as err:
+            print_fail(f"Invalid search: {err.orig}")
+            return []
+
+    def show_merged(self, results: dict) -> None:
+        """
+        Prints outputs grouped by content, so identical results across hosts show up once.
+        """
+        groups = {}
+        for host, output in results.items():
+            groups.setdefault((output or "").strip(), []).append(host)
+
+        columns = ["Hosts", "Count", "Output"]
+        tab = PrettyTable(columns, align="l")
+        for output, hosts in sorted(groups.items(), key=lambda group: len(group[1]), reverse=True):
+            tab.add_row(["\n".join(sorted(hosts)), len(hosts), output])
+        print(tab)
+
+def _load_rows(methods) -> None:
+    """
+    Loads the database rows methods need, so worker threads never lazy load through this
+    thread's session.
+    """
+    for method in methods:
+        method.table_instance.status
+        method.cred.cred
+        if method.tunnel is not None:
+            method.tunnel.port
+
+def _run_method_command(method, command: str) -> str:
+    try:
+        return method.run_command(command, silent=True)
+    finally:
+        db_session.remove()
+
+def _run_builtin(method, builtin: str, **kwargs) -> None:
+    try:
+        method.builtins(builtin, **kwargs)
+    finally:
+        db_session.remove()
+
+def _connect_method(method) -> bool:
+    try:
+        method.connect()
+        return method.table_instance.status == "Success"
+    finally:
+        # Drop the session this worker thread got from db_session
+        db_session.remove()
+
 class TargetsController(UserDict):
+    """
+    TargetController instances keyed by hostname, or IP address for targets without one.
+
+    Names are looked up in an in-memory index of the target table. The index is only reloaded
+    after a target row was inserted, updated or deleted, so lookups and completion don't query
+    the database every time.
+
+    Controllers are created the first time a target is used. Only the TARGET_CACHE_SIZE most
+    recently used ones stay loaded, apart from targets with running containers.
+    """
+
+    # Bumped by _targets_changed on every write to the target table
+    version = 0
+
     def __init__(self, op_path):
-        self.data = {}
+        self.data = OrderedDict()
         self.op_path = op_path
-        old_db = db_session.query(Target).all()
-        for row in old_db:
-            if row.hostname:
-                self.data[row.hostname] = TargetController(row.id, row.ip_addr, row.hostname, self.op_path)
-            else:
-                self.data[row.ip_addr] = TargetController(row.id, row.ip_addr, row.hostname, self.op_path)
+        self.index = {}
+        self.aliases = {}
+        self.index_version = None
 
     def __getitem__(self, key):
-        old_db = db_session.query(Target).all()
-        for row in old_db:
-            # Only create TargetController instance from database row if it doesn't already exist
-            # Prevents overwriting existing instances each time the list is referenced
-            # This allows better container management (reattach to existing sessions)
-            #self.data.setdefault(row.ip_addr, TargetController(row.ip_addr, row.hostname, self.op_path))
-            if row.hostname:
-                self.data.setdefault(row.hostname, TargetController(row.id, row.ip_addr, row.hostname, self.op_path))
-            elif row.ip_addr and not row.hostname:
-                self.data.setdefault(row.ip_addr, TargetController(row.id, row.ip_addr, row.hostname, self.op_path))
-        return super().__getitem__(key)
+        # Only create TargetController instances that don't already exist
+        # This allows better container management (reattach to existing sessions)
+        if key not in self.data:
+            self.refresh()
+            # Targets with a hostname can also be looked up by IP address
+            key = self.aliases.get(key, key)
+        if key not in self.data:
+            if key not in self.index:
+                raise KeyError(key)
+            id, ip_addr, hostname = self.index[key]
+            self.data[key] = TargetController(id, ip_addr, hostname, self.op_path)
+            self.evict()
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    # Only the loaded controllers, read directly. Going through __getitem__ would reorder
+    # self.data while it's being iterated
+    def items(self):
+        return list(self.data.items())
+
+    def values(self):
+        return list(self.data.values())
+
+    def evict(self) -> None:
+        """
+        Drops the least recently used controllers past TARGET_CACHE_SIZE.
+        """
+        # Never the newest one, it's about to be returned
+        for name in list(self.data)[:-1]:
+            if len(self.data) <= TARGET_CACHE_SIZE:
+                return
+            # Containers have to stay reachable to be reattached and cleaned up
+            if not self.data[name].busy:
+                del self.data[name]
+
+    def refresh(self) -> None:
+        """
+        Reloads the index if the target table changed since it was built.
+        """
+        if self.index_version == TargetsController.version:
+            return
+        self.index_version = TargetsController.version
+        self.index = {}
+        self.aliases = {}
+        for id, ip_addr, hostname in db_session.execute(select(Target.id, Target.ip_addr, Target.hostname)):
+            if hostname:
+                self.index[hostname] = (id, ip_addr, hostname)
+                if ip_addr:
+                    self.aliases[ip_addr] = hostname
+            elif ip_addr:
+                self.index[ip_addr] = (id, ip_addr, hostname)
+
+    def names(self) -> dict:
+        """
+        Returns a dict of target name -> IP address (None if the name is the IP address).
+        """
+        self.refresh()
+        return {name: ip_addr if hostname else None for name, (_, ip_addr, hostname) in self.index.items()}
 
     def append(self, ip_addr=None, hostname=None, **_):
         # Take **kwargs to handle arg parser
@@ -107,6 +369,12 @@ class TargetsController(UserDict):
             print_fail('This target already exists in the database')
         db_session.commit()
 
+@event.listens_for(Target, "after_insert")
+@event.listens_for(Target, "after_update")
+@event.listens_for(Target, "after_delete")
+def _targets_changed(mapper, connection, target) -> None:
+    TargetsController.version += 1
+
 class TargetController:
     def __init__(self, id, ip_addr, hostname, op_path):
         self.id = id
@@ -122,9 +390,12 @@ class TargetController:
         if not os.path.exists(self.op_path):
             os.makedirs(self.op_path)
 
-        self.credentials = CredentialsController(self)
-        self.methods = MethodsController(self)
-        self.tunnels = TunnelsController(self)
+        # Loaded on first use, see the properties below
+        self._credentials = None
+        self._methods = None
+        self._tunnels = None
+        self.filesystem = FilesystemTracker(self)
+        self.collection = HashIndex(self)
 
         self.actions = NestedCompleter.from_nested_dict({
             'show': {
@@ -133,10 +404,14 @@ class TargetController:
                 "settings": None,
                 "tunnels": None,
                 "containers": None,
+                "ports": None,
                 "targets": {
                     "--full"
                 },
             },
+            'connect': {
+                '--workers',
+            },
             'add': {
                 'credential': CredentialCompleter(),
                 "method": MethodCompleter(),
@@ -161,14 +436,40 @@ class TargetController:
             'exit': None,
         })
 
+    @property
+    def credentials(self):
+        if self._credentials is None:
+            self._credentials = CredentialsController(self)
+        return self._credentials
+
+    @property
+    def methods(self):
+        if self._methods is None:
+            self._methods = MethodsController(self)
+        return self._methods
+
+    @property
+    def tunnels(self):
+        if self._tunnels is None:
+            self._tunnels = TunnelsController(self)
+        return self._tunnels
+
+    @property
+    def busy(self) -> bool:
+        """
+        True if any of the target's methods has a container.
+        """
+        if self._methods is None:
+            return False
+        return any(method.container is not None for method in self._methods)
+
 class CredentialsController(UserList):
     def __init__(self, target):
         self.target = target
         self.data = []
-        #old_db = database.db_session.query(models.Credential).filter(models.Credential.targets.any(ip_addr=target.ip_addr))
-        old_db = db_session.query(Credential).all()
-        for row in old_db:
-            self.data.append(row)
+        # Highest credential id loaded, update() only asks for newer rows
+        self.last_id = 0
+        self.update()
 
     """def __getitem__(self, key):
         #old_db = database.db_session.query(models.Credential).filter(models.Credential.targets.any(ip_addr=target.ip_addr))
@@ -190,25 +491,61 @@ class CredentialsController(UserList):
 
             # Append to instance list
             self.data.append(credential)
+            self.last_id = max(self.last_id, credential.id)
             print_success("Credential successfully added")
         else:
             print_fail('This credential already exists in the database')
 
+    def bulk_add(self, credentials, batch_size: int=5000) -> int:
+        """
+        Adds many credentials in one transaction, skipping ones already stored, and links all
+        of them to the target. Takes an iterable of dicts with username, ctype and cred, and
+        optionally domain and origin, so a generator can feed it while output streams in.
+        Returns how many credentials were new.
+        """
+        added = 0
+        batch = []
+        for credential in credentials:
+            batch.append({"domain": None, "origin": "Manual", **credential})
+            if len(batch) >= batch_size:
+                added += self._insert(batch)
+                batch = []
+        added += self._insert(batch)
+        db_session.commit()
+        self.update()
+        return added
+
+    def _insert(self, batch: list) -> int:
+        if not batch:
+            return 0
+        # ix_credential_key turns duplicates into no-ops
+        result = db_session.execute(insert(Credential.__table__).prefix_with("OR IGNORE"), batch)
+        db_session.execute(
+            text(
+                "INSERT OR IGNORE INTO target_cred (target_id, cred_id) "
+                "SELECT :target_id, id FROM credential_t WHERE username = :username AND ctype = :ctype "
+                "AND cred = :cred AND coalesce(domain, '') = coalesce(:domain, '') AND origin = :origin"
+            ),
+            [{"target_id": self.target.id, **credential} for credential in batch],
+        )
+        return result.rowcount
+
     def update(self) -> None:
-        old_db = db_session.query(Credential).all()
-        for row in old_db:
-            # Don't append if already there
-            if row not in self.data:
-                self.data.append(row)
+        # Credentials are shared by every target, so the list holds all of them
+        # Rows are never deleted, so anything new has a higher id than what's loaded
+        # Rows added through append() are at or below last_id, so nothing is loaded twice
+        old_db = db_session.query(Credential).filter(Credential.id > self.last_id).order_by(Credential.id).all()
+        self.data.extend(old_db)
+        if old_db:
+            self.last_id = old_db[-1].id
 
 class TunnelsController(UserList):
     def __init__(self, target):
         self.target = target
         self.data = []
-        #old_db = database.db_session.query(models.Credential).filter(models.Credential.targets.any(ip_addr=target.ip_addr))
-        old_db = db_session.query(Tunnel).all()
-        for row in old_db:
-            self.data.append(row)
+        # Highest tunnel id loaded, update() only asks for newer rows
+        self.last_id = 0
+        self.update()
 
     def append(self, ip_addr, port, tunnel_type, **_):
         if db_session.query(Tunnel).filter(Tunnel.ip_addr==ip_addr, Tunnel.port==port, Tunnel.tunnel_type==tunnel_type).count() == 0:
@@ -222,16 +559,17 @@ class TunnelsController(UserList):
 
             # Append to instance list
             self.data.append(tunnel)
+            self.last_id = max(self.last_id, tunnel.id)
             print_success("Tunnel successfully added")
         else:
             print_fail('This tunnel already exists in the database')
 
     def update(self) -> None:
-        old_db = db_session.query(Tunnel).all()
-        for row in old_db:
-            # Don't append if already there
-            if row not in self.data:
-                self.data.append(row)
+        # Tunnels aren't tied to a target, so the list holds all of them
+        old_db = db_session.query(Tunnel).filter(Tunnel.id > self.last_id).order_by(Tunnel.id).all()
+        self.data.extend(old_db)
+        if old_db:
+            self.last_id = old_db[-1].id
 
 #class CommandsController(UserList):
 #    def __init__(self, target):
@@ -1,12 +1,8 @@
-import os
 import re
 from typing import Iterable
 from prompt_toolkit.completion import Completer, Completion
 from prompt_toolkit.completion.base import CompleteEvent, Completion
 from prompt_toolkit.document import Document
-from .database import db_session
-from redshell import config
-from .models import Target
 from .methods import MethodBase
 from .methods.builtins import BuiltinBase
 
@@ -39,25 +35,18 @@ class TargetCompleter(Completer):
     """
     Custom Prompt Toolkit completer that displays targets in the database.
     """
+    def __init__(self, rsh) -> None:
+        self.rsh = rsh
+        super().__init__()
+
     def get_completions(self, document, complete_event):
         word = document.get_word_before_cursor(WORD=True)
-        targets = db_session.query(Target).all()
-
-        target_dict = {}
-
-        for target in targets:
-            if target.hostname and not target.ip_addr:
-                target_dict[target.hostname] = "N/A"
-            elif target.hostname and target.ip_addr:
-                target_dict[target.hostname] = target.ip_addr
-            elif target.ip_addr and not target.hostname:
-                target_dict[target.ip_addr] = "N/A"
-        for target in target_dict:
+        for target, ip_addr in self.rsh.targets.names().items():
             if target.startswith(word):
                 yield Completion(
                     target,
                     start_position=-len(word),
-                    display_meta=target_dict[target],
+                    display_meta=ip_addr or "N/A",
                 )
 
 class MethodCompleter(Completer):
@@ -81,39 +70,17 @@ class FilesystemCompleter(Completer):
         super().__init__()
 
     def get_completions(self, document: Document, complete_event: CompleteEvent) -> Iterable[Completion]:
-        configuration = config.read_config()
-        op_path = configuration["op_path"]
-        file_tracker = f"{op_path}{self.method.host}/filesystem.txt"
-        try:
-            with open(file_tracker, "r") as file:
-                filesystem = file.read()
-        except FileNotFoundError:
-            return
-
         text = document.text_before_cursor
 
-        dirname = os.path.dirname(text)
-        basename = os.path.basename(text)
-
-        # Get only files that match
-        filesystem = filesystem.split("\n")
-        matching_files = []
-        for name in filesystem:
-            if name.startswith(dirname):
-                matching_files.append(name)
+        # Only the entries of the directory being typed, not everything below it
+        path = text.strip('"')
+        split = max(path.rfind("/"), path.rfind("\\")) + 1
+        matching_files = self.method.target.filesystem.children(path[:split], path[split:])
 
-        # Need to have it replace the whole filename, not add to the end of what was typed
-        # Still need to work on getting it to show the root "/"
-        # I think ^^ are fixed now for Linux and Windows, just needs more testing
+        # Replace the whole path typed so far, not add to the end of it
         for file in matching_files:
-            #if dirname != "/":
-            #    completion = file[len(dirname) + 1:]
-            #else:
-            #    completion = file
-            completion = file
             yield Completion(
-                f'"{completion}"',
-                #display=completion[1:-1],
+                f'"{file}"',
                 start_position=(len(text) * -1),
             )
 
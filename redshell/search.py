@@ -0,0 +1,157 @@
+import re
+from sqlalchemy import select, update
+from .database import engine
+from .models import Command, Target
+from .blobs import blob_store
+
+# One row per distinct output, rowid is derived from the output's blob hash. Contentless, the
+# outputs themselves are only kept in the blob store
+SEARCH_TABLE = "output_fts"
+# rowid -> result_hash, a contentless table can't give back its columns
+HASH_TABLE = "output_fts_hash"
+# Words of context around the first match in a snippet, like FTS5's snippet()
+SNIPPET_TOKENS = 12
+
+def _rowid(result_hash: str) -> int:
+    # 60 bits of the hash, fits SQLite's signed 64 bit rowid
+    return int(result_hash[:15], 16)
+
+def create_index() -> None:
+    """
+    Creates the search index if it doesn't exist yet and fills it with every command already
+    in the database.
+    """
+    with engine.begin() as connection:
+        existing = connection.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (SEARCH_TABLE,)
+        ).scalar()
+        if existing is not None and "content=''" in existing:
+            return
+        # Indexes from before it was contentless hold a second copy of every output
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+        connection.exec_driver_sql(f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(output, content='')")
+        connection.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {HASH_TABLE} (rowid INTEGER PRIMARY KEY, result_hash TEXT NOT NULL)")
+        connection.exec_driver_sql(f"DELETE FROM {HASH_TABLE}")
+
+        # Rows from before the blob store still have their output inline
+        legacy = connection.execute(
+            select(Command.id, Command.result).where(Command.result_hash == None, Command.result != None)
+        ).all()
+        for command_id, result in legacy:
+            connection.execute(update(Command).where(Command.id == command_id).values(result_hash=blob_store.put(result)))
+
+        outputs = {}
+        for (result_hash,) in connection.execute(select(Command.result_hash).where(Command.result_hash != None).distinct()):
+            outputs[result_hash] = blob_store.get(result_hash)
+        index_outputs(connection, outputs)
+
+def index_outputs(connection, outputs: dict) -> None:
+    """
+    Adds result_hash -> output pairs to the index, skipping outputs that are already in it.
+    """
+    if not outputs:
+        return
+    new = [(_rowid(result_hash), result_hash, output) for result_hash, output in outputs.items()]
+    indexed = set()
+    rowids = [rowid for rowid, _, _ in new]
+    # Chunked to stay under SQLite's bound parameter limit
+    for i in range(0, len(rowids), 500):
+        chunk = rowids[i:i + 500]
+        indexed.update(connection.exec_driver_sql(
+            f"SELECT rowid FROM {HASH_TABLE} WHERE rowid IN ({', '.join('?' * len(chunk))})", tuple(chunk)
+        ).scalars())
+    new = [row for row in new if row[0] not in indexed]
+    if not new:
+        return
+    connection.exec_driver_sql(
+        f"INSERT INTO {HASH_TABLE}(rowid, result_hash) VALUES (?, ?)",
+        [(rowid, result_hash) for rowid, result_hash, _ in new],
+    )
+    connection.exec_driver_sql(
+        f"INSERT INTO {SEARCH_TABLE}(rowid, output) VALUES (?, ?)",
+        [(rowid, output) for rowid, _, output in new],
+    )
+
+def search(query: str, target_id=None, limit: int=20, raw: bool=False) -> list:
+    """
+    Returns (target, command line, time run, snippet) for commands whose output matches query,
+    best matches first.
+
+    Every word of the query has to appear in the output. Words are matched as phrases, so
+    'MsMpEng.exe' works as typed. With raw, query is passed to FTS5 as is.
+    """
+    if not raw:
+        query = " ".join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+    # Rank outputs inside FTS5 first, so snippets are only built for the outputs shown
+    best = f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH ? ORDER BY rank LIMIT ?"
+    parameters = [query, limit]
+    if target_id is not None:
+        best = (
+            f"SELECT {SEARCH_TABLE}.rowid FROM {SEARCH_TABLE} "
+            f"WHERE {SEARCH_TABLE} MATCH ? AND {SEARCH_TABLE}.rowid IN ("
+            f"SELECT h.rowid FROM {HASH_TABLE} h JOIN command_t c ON c.result_hash = h.result_hash WHERE c.target_id = ?) "
+            f"ORDER BY rank LIMIT ?"
+        )
+        parameters = [query, target_id, limit]
+    sql = (
+        f"SELECT COALESCE(t.hostname, t.ip_addr), c.command_line, c.time_run, h.result_hash "
+        f"FROM {SEARCH_TABLE} "
+        f"JOIN {HASH_TABLE} h ON h.rowid = {SEARCH_TABLE}.rowid "
+        f"JOIN command_t c ON c.result_hash = h.result_hash "
+        f"JOIN target_t t ON t.id = c.target_id "
+        f"WHERE {SEARCH_TABLE} MATCH ? AND {SEARCH_TABLE}.rowid IN ({best})"
+    )
+    parameters = [query, *parameters]
+    if target_id is not None:
+        sql = f"{sql} AND c.target_id = ?"
+        parameters.append(target_id)
+    sql = f"{sql} ORDER BY {SEARCH_TABLE}.rank, c.time_run DESC LIMIT ?"
+    parameters.append(limit)
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(sql, tuple(parameters)).all()
+
+    # The index keeps no text, snippets come from the blob store
+    terms = _query_terms(query)
+    snippets = {}
+    results = []
+    for target, command_line, time_run, result_hash in rows:
+        if result_hash not in snippets:
+            snippets[result_hash] = _snippet(blob_store.get(result_hash), terms)
+        results.append((target, command_line, time_run, snippets[result_hash]))
+    return results
+
+def _query_terms(query: str) -> list:
+    """
+    Lower cased words of an FTS5 query, ending in '*' for prefix matches. Operators are left out.
+    """
+    terms = []
+    for term in re.findall(r"\w+\*?", query):
+        if term not in ("AND", "OR", "NOT", "NEAR"):
+            terms.append(term.lower())
+    return terms
+
+def _snippet(output: str, terms: list) -> str:
+    """
+    The words around the first match in output, matched words marked with >> and <<, the way
+    snippet() marks them for an FTS5 table that stores its content.
+    """
+    tokens = list(re.finditer(r"\w+", output))
+
+    def matches(token) -> bool:
+        word = token.group(0).lower()
+        return any(word.startswith(term[:-1]) if term.endswith("*") else word == term for term in terms)
+
+    first = next((i for i, token in enumerate(tokens) if matches(token)), 0)
+    start = max(0, min(first - SNIPPET_TOKENS // 4, len(tokens) - SNIPPET_TOKENS))
+    window = tokens[start:start + SNIPPET_TOKENS]
+    if not window:
+        return ""
+    snippet = "" if start == 0 else "..."
+    position = window[0].start()
+    for token in window:
+        snippet += output[position:token.start()]
+        snippet += f">>{token.group(0)}<<" if matches(token) else token.group(0)
+        position = token.end()
+    if start + SNIPPET_TOKENS < len(tokens):
+        snippet += "..."
+    return snippet
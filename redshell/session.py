@@ -0,0 +1,177 @@
+import re
+import uuid
+import queue
+import threading
+from concurrent.futures import Future
+import pexpect
+
+# Semi-interactive Windows shell prompt, e.g. "C:\>" or "C:\Windows\system32>"
+WINDOWS_PROMPT = re.compile(r"^[A-Za-z]:\\[^>\n]*>")
+
+class SessionError(Exception):
+    pass
+
+class AttachedSession:
+    """
+    Sends commands to the semi-interactive shell of an already running container over
+    'docker attach', so authentication only happens once per container instead of once per
+    command.
+
+    Every command is framed by echo markers. The caret in the marker is eaten by cmd.exe, so the
+    marker only matches in command output and never in the terminal echo of what was sent.
+
+    Commands submitted while the session is busy wait in a queue and are then written to the
+    shell back to back, so a burst of commands costs one round of prompt handling.
+    """
+
+    def __init__(self, container_name: str, timeout: int=300) -> None:
+        self.container_name = container_name
+        self.timeout = timeout
+        self.child = None
+        # Only one batch can be in flight on the shared terminal
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.worker = None
+        # Held while queueing, and by the worker while it decides to exit, so a command is never
+        # queued behind a worker that is about to return
+        self.worker_lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.child is not None and self.child.isalive()
+
+    def open(self) -> None:
+        # Signals sent to the attach process must never reach the container's shell
+        self.child = pexpect.spawn(
+            f"docker attach --sig-proxy=false {self.container_name}",
+            timeout=self.timeout,
+        )
+
+    def close(self) -> None:
+        if self.child is not None:
+            self.child.close(force=True)
+        self.child = None
+
+    def submit(self, command: str) -> Future:
+        """
+        Queues a command for the session and returns a future for its output.
+        """
+        future = Future()
+        with self.worker_lock:
+            self.queue.put((command, future))
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._drain_queue, daemon=True)
+                self.worker.start()
+        return future
+
+    def run(self, command: str) -> str:
+        """
+        Runs a single command in the session and returns its output.
+        """
+        return self.submit(command).result()
+
+    def _drain_queue(self) -> None:
+        while True:
+            try:
+                pending = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                with self.worker_lock:
+                    if self.queue.empty():
+                        self.worker = None
+                        return
+                continue
+            # Everything queued so far goes out in the same batch
+            while True:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            commands = [command for command, _ in pending]
+            try:
+                outputs = self.run_batch(commands)
+            except SessionError as err:
+                for _, future in pending:
+                    future.set_exception(err)
+                continue
+            for (_, future), output in zip(pending, outputs):
+                future.set_result(output)
+
+    def run_batch(self, commands: list) -> list:
+        """
+        Writes all commands to the shell at once and returns their outputs in order.
+        """
+        with self.lock:
+            marker = uuid.uuid4().hex[:12]
+            try:
+                if not self.alive:
+                    self.open()
+                self.child.sendline(f"echo RSH^_START_{marker}")
+                for i, command in enumerate(commands):
+                    self.child.sendline(command)
+                    self.child.sendline(f"echo RSH^_END_{marker}_{i}")
+                self.child.expect(f"RSH_START_{marker}")
+                outputs = []
+                for i, command in enumerate(commands):
+                    self.child.expect(f"RSH_END_{marker}_{i}\\b")
+                    outputs.append(_clean_output(self.child.before.decode(errors="replace"), command))
+            # EOF, TIMEOUT and failing to spawn 'docker attach' at all
+            except pexpect.ExceptionPexpect as err:
+                self.close()
+                raise SessionError(f"lost session with {self.container_name}") from err
+            return outputs
+
+def _clean_output(output: str, command: str) -> str:
+    """
+    Strips prompts and the terminal echo of sent lines out of framed session output.
+    """
+    cleaned = []
+    for line in output.replace("\r", "").split("\n"):
+        # Drop the prompt, the shell may print it in front of echoed input
+        line = WINDOWS_PROMPT.sub("", line)
+        if "RSH^_" in line or line.strip() == command.strip():
+            continue
+        cleaned.append(line)
+    return "\n".join(cleaned).strip()
+
+def cmd_script(commands: list, marker: str) -> str:
+    """
+    Joins cmd commands into one line that runs them in a single remote execution, each output
+    preceded by an echoed marker. The caret keeps the marker out of the echoed command.
+    """
+    # wmiexec only captures the output of the last command of a plain '&' chain, so the whole
+    # script has to be one group
+    script = " & ".join(f"echo RSH^_{marker}_{i} & {command}" for i, command in enumerate(commands))
+    return f"({script})"
+
+def split_script_output(output: str, marker: str, count: int) -> list:
+    """
+    Splits the output of a cmd_script() back into one output per command.
+    """
+    outputs = [""] * count
+    current = None
+    for line in output.replace("\r", "").split("\n"):
+        match = re.match(f"^RSH_{marker}_(\\d+)\\s*$", line)
+        if match:
+            current = int(match.group(1))
+        elif current is not None:
+            outputs[current] += f"{line}\n"
+    return [output.strip() for output in outputs]
+
+def script_chunks(commands: list, limit: int) -> list:
+    """
+    Splits commands into as few groups as possible whose cmd_script() stays within limit
+    characters. A command too long on its own gets a group to itself.
+    """
+    # Group parentheses plus, per command, the marker echo and the joining ampersands
+    overhead = len(cmd_script([], "x" * 12))
+    chunks = []
+    length = overhead
+    for i, command in enumerate(commands):
+        command_length = len(f" & echo RSH^_{'x' * 12}_{i} & {command}")
+        if chunks and length + command_length <= limit:
+            chunks[-1].append(command)
+            length += command_length
+        else:
+            chunks.append([command])
+            length = overhead + command_length
+    return chunks
@@ -0,0 +1,112 @@
+import re
+import gzip
+import base64
+import shlex
+import binascii
+from .collection import powershell_command, ps_quote
+
+# Prints RSH_HAS_<tool> for every tool the target has that can do its side of the compression
+LINUX_PROBE = "for tool in gzip base64 python3 python; do command -v $tool >/dev/null 2>&1 && echo RSH_HAS_$tool; done; true"
+WINDOWS_PROBE = "powershell -NoProfile -Command Write-Output RSH_HAS_powershell"
+
+# Both run under Python 2 and 3. 31 window bits reads and writes gzip rather than raw zlib
+PYTHON_ENCODER = "import sys,zlib,base64;c=zlib.compressobj(9,zlib.DEFLATED,31);d=getattr(sys.stdin,'buffer',sys.stdin).read();sys.stdout.write(base64.b64encode(c.compress(d)+c.flush()).decode())"
+PYTHON_DECODER = "import sys,zlib,base64;getattr(sys.stdout,'buffer',sys.stdout).write(zlib.decompress(base64.b64decode(sys.stdin.read()),31))"
+# Runs a compressed script from stdin without it ever touching the disk
+PYTHON_LOADER = "import sys,zlib,base64;exec(zlib.decompress(base64.b64decode(sys.stdin.read()),31))"
+
+# Runs a cmd command and gives back its output gzipped and base64 encoded
+WINDOWS_WRAPPER = """
+$output = (cmd.exe /c "$({command}) 2>&1") -join [Environment]::NewLine
+$bytes = [Text.Encoding]::UTF8.GetBytes($output)
+$buffer = New-Object IO.MemoryStream
+$gzip = New-Object IO.Compression.GZipStream($buffer, [IO.Compression.CompressionMode]::Compress)
+$gzip.Write($bytes, 0, $bytes.Length)
+$gzip.Close()
+'{marker}' + [Convert]::ToBase64String($buffer.ToArray())
+"""
+# cmd.exe takes at most 8191 characters, less what wmiexec and smbexec put around the command
+WINDOWS_COMMAND_LIMIT = 7900
+# Scripts that are already encoded, wrapping them would encode them a second time at ~2.7x the length
+ENCODED_POWERSHELL = re.compile(r"^\s*powershell(\.exe)?\b.*\s-e(c|nc|ncodedcommand)?\s", re.IGNORECASE)
+
+# Marks where the encoded output starts, anything the shell prints before it is dropped
+MARKER = "RSH_GZ:"
+
+class Compression:
+    """
+    gzip+base64 wrapping for commands, payloads and output, using whichever tool the target
+    has for its side: gzip and base64, a Python interpreter, or PowerShell.
+    """
+
+    def __init__(self, tool: str) -> None:
+        self.tool = tool
+
+    def wrap(self, command: str) -> str:
+        """
+        Returns a command line that runs command on the target and prints its output compressed.
+        Windows commands that are already encoded or would get too long are returned as they are.
+        """
+        if self.tool == "powershell":
+            if ENCODED_POWERSHELL.match(command):
+                return command
+            wrapped = powershell_command(WINDOWS_WRAPPER.format(command=ps_quote(command), marker=MARKER))
+            return wrapped if len(wrapped) <= WINDOWS_COMMAND_LIMIT else command
+        # Newline before the brace so a trailing comment or '&' in the command can't swallow it
+        return f"echo {MARKER}; {{ {command}\n}} 2>&1 | {self.encoder()}"
+
+    def encoder(self) -> str:
+        """
+        Shell pipeline stage on a Linux target turning stdin into gzip+base64.
+        """
+        if self.tool == "gzip":
+            return "gzip -c | base64"
+        return f"{self.tool} -c {shlex.quote(PYTHON_ENCODER)}"
+
+    def decoder(self) -> str:
+        """
+        Shell pipeline stage on a Linux target turning gzip+base64 from stdin back into plain data.
+        """
+        if self.tool == "gzip":
+            return "base64 -d | gunzip -c"
+        return f"{self.tool} -c {shlex.quote(PYTHON_DECODER)}"
+
+    def __str__(self) -> str:
+        return self.tool
+
+def compress(data: bytes) -> bytes:
+    """
+    gzip+base64 encodes a payload before it's sent to the target.
+    """
+    return base64.b64encode(gzip.compress(data, compresslevel=9))
+
+def unwrap(output: str) -> str:
+    """
+    Decodes the output of a wrapped command. Returns None if it isn't valid compressed output,
+    e.g. because the wrapper itself failed on the target.
+    """
+    _, found, encoded = output.rpartition(MARKER)
+    if not found:
+        return None
+    try:
+        return gzip.decompress(base64.b64decode("".join(encoded.split()))).decode(errors="replace")
+    except (binascii.Error, OSError, EOFError):
+        return None
+
+def detect(method) -> Compression:
+    """
+    Works out what the target of a connected method can compress and decompress with.
+    Returns None if it has nothing usable.
+    """
+    if "Windows" in method.TARGET_OS:
+        output = method.run_command(WINDOWS_PROBE, silent=True) or ""
+        return Compression("powershell") if "RSH_HAS_powershell" in output else None
+
+    output = method.run_command(LINUX_PROBE, silent=True) or ""
+    tools = {line.strip()[len("RSH_HAS_"):] for line in output.split("\n") if line.strip().startswith("RSH_HAS_")}
+    if {"gzip", "base64"} <= tools:
+        return Compression("gzip")
+    for interpreter in ("python3", "python"):
+        if interpreter in tools:
+            return Compression(interpreter)
+    return None
@@ -0,0 +1,138 @@
+import os
+import time
+import select
+import ctypes
+import ctypes.util
+import threading
+
+# inotify flags, from <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+
+class ConnectWatcher:
+    """
+    Waits for a freshly started method container to connect or fail without polling Docker.
+
+    The first of these to happen settles the wait:
+        - Docker reports a 'die' event for the container -> "failed"
+        - one of the success markers shows up in the container's logs -> "connected"
+        - the watched path (SSH control socket) is created -> "connected"
+        - the container survives 'settle' seconds without dying -> "connected"
+    Nothing happening before the timeout gives "timeout".
+    """
+
+    def __init__(self, client, container, since: int, markers: list=None, path: str=None, settle: float=None) -> None:
+        self.client = client
+        self.container = container
+        self.since = since
+        self.markers = markers or []
+        self.path = path
+        self.settle = settle
+
+        self.result = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.streams = []
+
+    def wait(self, timeout: float) -> str:
+        # Streams are opened here rather than in the threads, so every one of them is in
+        # self.streams and gets closed below however early the wait ends
+        # 'since' replays a die event that happened before the stream was opened
+        events = self.client.events(
+            decode=True,
+            since=self.since,
+            filters={"container": self.container.id, "event": "die"},
+        )
+        self.streams.append(events)
+        watchers = [(self._watch_events, events)]
+        if self.markers:
+            logs = self.container.logs(stream=True, follow=True)
+            self.streams.append(logs)
+            watchers.append((self._watch_logs, logs))
+        if self.path:
+            watchers.append((self._watch_path,))
+        for watcher, *args in watchers:
+            threading.Thread(target=watcher, args=args, daemon=True).start()
+
+        wait_time = timeout
+        if self.settle is not None:
+            wait_time = min(timeout, self.settle)
+        if not self.done.wait(wait_time):
+            self._finish("connected" if self.settle is not None and self.settle < timeout else "timeout")
+
+        # Unblock the streaming threads
+        for stream in self.streams:
+            try:
+                stream.close()
+            except Exception:
+                pass
+        return self.result
+
+    def _finish(self, result: str) -> None:
+        with self.lock:
+            if self.result is None:
+                self.result = result
+                self.done.set()
+
+    def _watch_events(self, events) -> None:
+        try:
+            for _ in events:
+                self._finish("failed")
+                return
+        except Exception:
+            # Stream closed by wait()
+            pass
+
+    def _watch_logs(self, logs) -> None:
+        output = ""
+        try:
+            for chunk in logs:
+                output += chunk.decode(errors="replace")
+                if any(marker in output for marker in self.markers):
+                    self._finish("connected")
+                    return
+        except Exception:
+            return
+        # Log stream only ends when the container stops
+        self._finish("failed")
+
+    def _watch_path(self) -> None:
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd = _inotify_fd(directory)
+        try:
+            while not self.done.is_set():
+                if os.path.exists(self.path):
+                    self._finish("connected")
+                    return
+                # inotify wakes this up as soon as something is created in the directory,
+                # without it fall back to short local checks
+                if fd is not None:
+                    readable, _, _ = select.select([fd], [], [], 0.5)
+                    if readable:
+                        try:
+                            os.read(fd, 4096)
+                        except BlockingIOError:
+                            pass
+                else:
+                    time.sleep(0.05)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+def _inotify_fd(directory: str):
+    """
+    Returns an inotify file descriptor watching 'directory' for new files, or None if inotify
+    isn't available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, directory.encode(), IN_CREATE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd